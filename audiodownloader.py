@@ -10,60 +10,156 @@ Description:    This file handles all API requests and audio specific functions.
                     for an Anki card, save it to the user's collection.media, and return the file name.
 """
 import requests
+import threading
 import json
-import re
 import os
 import hashlib
 import mimetypes
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+from .ratelimit import HostRateLimiter, get_host, is_loopback
+from .lookupcache import MISS
+from .mediaindex import MediaHashIndex, TEMP_FILE_PREFIX
+from .urltemplate import UrlTemplate
+from .fingerprints import AudioFingerprints, JPOD101_NO_AUDIO_SHA256
+from .sourcestats import SourceStats
+from .timeouts import AdaptiveTimeout, DEFAULT_MULTIPLIER, DEFAULT_MIN_TIMEOUT
+from .audiopack import AudioPack, DEFAULT_PATTERN
+from .batchlookup import BatchLookup, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_METHOD
+from .retry import RetryLater, is_retryable, retry_delay, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF
+from .circuitbreaker import CircuitBreaker, CircuitOpen, is_breaker_failure, DEFAULT_THRESHOLD, DEFAULT_COOLDOWN
+from .metrics import RunMetrics, OUTCOME_HIT, OUTCOME_MISS, OUTCOME_PLACEHOLDER, OUTCOME_CACHED_HIT, \
+    OUTCOME_CACHED_MISS
 
 DEFAULT_TIMEOUT = 15
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024         # Largest audio file that will be downloaded, per source with 'max_size'
+DEFAULT_MAX_JSON_SIZE = 1024 * 1024         # Largest JSON response that will be read into memory
+BATCH_MAX_JSON_SIZE = 16 * 1024 * 1024      # Same for the answer to a batch lookup, which lists many terms
+MAX_ERROR_PAYLOAD_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+HEAD_SIZE = 64                              # Amount of leading bytes kept from each download to fingerprint it
+CANCEL_POLL_INTERVAL = 0.1                  # How often a raced download waiting on a rate limit checks for a cancel
+NOT_AUDIO_CONTENT_TYPES = ('text/', 'application/json', 'application/xml', 'application/xhtml')
+# Statuses that mean the source answered, but has no audio for the requested term
+MISS_STATUS_CODES = (404, 410)
+DEFAULT_MAX_CANDIDATES = 5                  # URLs tried from a single JSON response, per source with 'max_candidates'
+# In order to bypass certain limitations from sites that require a browser to access,
+#   this header makes it look like we are using a browser instead of whatever is default
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+
+
+class ResponseTooLarge(ValueError):
+    """
+    Raised when a response body goes over the allowed size
+    """
+    pass
 
 
-# Static funcs
-def substitute_string_vars(s, replace_dict, duplicate_fld):
+class NotAudio(ValueError):
     """
-    Substitutes any variable in {} in the string (s) with a corresponding entry in replace_dict
+    Raised when a response that should be audio turns out to be something else (an error page, ...)
     """
-    # validate string so that all variable names (between {}) are lowercase
-    val_str = ""
-    for sub_str in re.split('({[^}]*})', s):
-        if sub_str.startswith('{'):
-            val_str += sub_str.lower()
-        else:
-            val_str += sub_str
+    pass
+
+
+class DownloadCancelled(Exception):
+    """
+    Raised when a download is aborted because its result is no longer needed
+    """
+    pass
+
 
-    relevant_keys = []
-    prev_val = ""
-    for key, value in replace_dict.items():
-        if val_str.find("{" + key.lower() + "}") >= 0:
-            if value == "" and duplicate_fld:
-                value = prev_val
-            relevant_keys.append(key)
-            val_str = val_str.replace("{" + key.lower() + "}", value)
-            prev_val = value
+class ChildEvent(threading.Event):
+    """
+    An event that also counts as set once its parent event is, so the downloads it aborts are aborted along with it
+    """
+    def __init__(self, parent=None):
+        super().__init__()
+        self.parent = parent
+
+    def is_set(self):
+        return super().is_set() or (self.parent is not None and self.parent.is_set())
 
-    return val_str, relevant_keys
+    def wait(self, timeout=None):
+        """
+        Waits until this event or its parent is set, checking the parent every CANCEL_POLL_INTERVAL seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = CANCEL_POLL_INTERVAL if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            super().wait(min(remaining, CANCEL_POLL_INTERVAL))
+        return self.is_set()
 
 
-def get_request(url, allow_redirects=True):
+class FetchedAudio:
     """
-    Performs a GET request to the specified url
+    Audio fetched from a source that the note may or may not end up using
+    Either file_name is set (the audio is already in collection.media), or temp_path points at the downloaded file
+    """
+    __slots__ = ('file_name', 'temp_path', 'digest', 'size', 'audio_ext')
+
+    def __init__(self, file_name=None, temp_path=None, digest=None, size=0, audio_ext=None):
+        self.file_name = file_name
+        self.temp_path = temp_path
+        self.digest = digest
+        self.size = size
+        self.audio_ext = audio_ext
+
+    def discard(self):
+        """
+        Removes the temporary file of a download that won't be used
+        """
+        if self.temp_path:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+
+
+# Static funcs
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Creates a requests Session that keeps up to pool_size connections alive for reuse
+    """
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def open_request(url, allow_redirects=True, session=None, timeout=DEFAULT_TIMEOUT, json_body=None):
+    """
+    Performs a GET request to the specified url without reading the body yet
     Uses a predefined User-Agent to make it look like we are accessing it from the browser
+    If a session is given, its pooled keep-alive connections are used instead of opening a new one
+    timeout is in seconds, or a (connect, read) tuple
+    If a json_body is given, it is POSTed instead
+    Returns the streaming response, whether it is JSON, and the extension the audio should be saved with
     """
     if url is None or not url.startswith("http"):
         raise Exception(url)
 
-    # In order to bypass certain limitations from sites that require a browser to access,
-    #   this header makes it look like we are using a browser instead of whatever is default
-    response = requests.request(
-        method="GET",
-        headers={
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'},
+    response = (session or requests).request(
+        method="GET" if json_body is None else "POST",
+        headers=DEFAULT_HEADERS,
         url=url,
-        timeout=DEFAULT_TIMEOUT
+        json=json_body,
+        timeout=timeout,
+        stream=True
     )
 
-    if not response:
+    if response is None:
         raise IOError("No response for %s", url)
 
     if response.status_code != 200:
@@ -71,14 +167,17 @@ def get_request(url, allow_redirects=True):
             "Got %d status for %s" %
             (response.status_code, url)
         )
+        value_error.status_code = response.status_code
+        value_error.retry_after = response.headers.get('Retry-After')
         try:
-            value_error.payload = response.content
-            response.close()
+            value_error.payload = read_response(response, MAX_ERROR_PAYLOAD_SIZE)
         except Exception:
             pass
+        response.close()
         raise value_error
 
     if not allow_redirects and response.url != url:
+        response.close()
         raise ValueError("Request has been redirected")
 
     content_type = response.headers.get('Content-Type', '')
@@ -93,46 +192,147 @@ def get_request(url, allow_redirects=True):
                 audio_ext = '.aac'
             else:
                 audio_ext = os.path.splitext(response.url)[1]
-    payload = response.content
-    response.close()
 
-    return payload, is_json, audio_ext
+    return response, is_json, audio_ext
 
 
-def filter_urls_list(arr):
+def check_content_length(response, max_size):
     """
-    Recursive helper for  filter_urls_dict
+    Raises a ResponseTooLarge error early if the server says the body is bigger than max_size
     """
-    for val in arr:
-        if type(val) is dict:
-            return filter_urls_dict(val)
-        elif type(val) is list:
-            return filter_urls_list(val)
-        else:
-            return  # we shouldn't get here?
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > max_size:
+        response.close()
+        raise ResponseTooLarge("%s bytes is over the %d byte limit for %s" % (content_length, max_size, response.url))
 
 
-def filter_urls_dict(dictionary):
+def read_response(response, max_size):
+    """
+    Reads a streaming response into memory, raising a ResponseTooLarge error once it goes over max_size
     """
-    Expects a dictionary
-    Recursively searches and filters out any urls from the json
-    for now, this just returns the first url it finds
+    check_content_length(response, max_size)
+    payload = bytearray()
+    try:
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            payload += chunk
+            if len(payload) > max_size:
+                raise ResponseTooLarge("Response is over the %d byte limit for %s" % (max_size, response.url))
+    finally:
+        response.close()
+    return bytes(payload)
+
+
+def stream_to_file(response, directory, max_size, cancel_event=None):
     """
-    # raise Exception(dictionary)
-    for key in dictionary:
-        if type(dictionary[key]) is dict:
-            return filter_urls_dict(dictionary[key])
-        elif type(dictionary[key]) is list:
-            return filter_urls_list(dictionary[key])
-        elif key.lower() == 'url':
-            return dictionary[key]
+    Streams an audio response to a temporary file in the directory, hashing it on the way
+    The download is aborted as soon as it goes over max_size, turns out not to be audio, or cancel_event is set
+    Returns the temporary file's path, the SHA-256 digest, the size and the first bytes of the audio
+    """
+    content_type = response.headers.get('Content-Type', '').lower()
+    if content_type.startswith(NOT_AUDIO_CONTENT_TYPES):
+        response.close()
+        raise NotAudio("Got %s instead of audio for %s" % (content_type, response.url))
+    check_content_length(response, max_size)
+
+    m = hashlib.sha256()
+    size = 0
+    head = b''
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, suffix='.part', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DownloadCancelled(response.url)
+                if size == 0 and chunk.lstrip()[:1] in (b'<', b'{'):
+                    raise NotAudio("Got markup instead of audio for %s" % response.url)
+                size += len(chunk)
+                if size > max_size:
+                    raise ResponseTooLarge("Response is over the %d byte limit for %s" % (max_size, response.url))
+                if len(head) < HEAD_SIZE:
+                    head += chunk[:HEAD_SIZE - len(head)]
+                m.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    finally:
+        response.close()
+
+    return temp_path, m.hexdigest(), size, head
+
+
+def select_json_path(document, json_path):
+    """
+    Returns the values at a simple dotted path into a JSON document, in document order
+    Each part of the path is a key, a list index, or * for every item of a list or every value of an object,
+        e.g. 'audioSources.*.url'
+    """
+    values = [document]
+    for part in json_path.split('.'):
+        selected = []
+        for value in values:
+            if part == '*':
+                if isinstance(value, dict):
+                    selected.extend(value.values())
+                elif isinstance(value, list):
+                    selected.extend(value)
+            elif isinstance(value, dict):
+                if part in value:
+                    selected.append(value[part])
+            elif isinstance(value, list) and part.lstrip('-').isdigit():
+                index = int(part)
+                if -len(value) <= index < len(value):
+                    selected.append(value[index])
+        values = selected
+    return values
+
+
+def extract_urls(document, json_path=None):
+    """
+    Returns every candidate audio URL in a JSON document, in document order and without duplicates
+    Without a json_path, every string value of a 'url' key (in any casing) is a candidate
+    With one, the strings it selects are the candidates, and 'url' keys are searched for inside anything else it selects
+    The document is walked with an explicit stack, so deeply nested responses can't hit the recursion limit
+    """
+    if json_path:
+        roots = select_json_path(document, json_path)
+        stack = [(None, value) for value in reversed(roots)]
+    else:
+        stack = [(None, document)]
+
+    urls = []
+    seen = set()
+    while stack:
+        key, value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(reversed(list(value.items())))
+        elif isinstance(value, list):
+            stack.extend((None, item) for item in reversed(value))
+        elif isinstance(value, str) and value.startswith('http') and \
+                (key is None and json_path or key is not None and key.lower() == 'url'):
+            if value not in seen:
+                seen.add(value)
+                urls.append(value)
+    return urls
+
+
+def discard_race_result(future):
+    """
+    Done callback for raced downloads that lost, cleans up whatever they downloaded
+    """
+    if future.cancelled():
+        return
+    fetched = future.result()[0]
+    if fetched:
+        fetched.discard()
 
 
-def save_from_https(media_content, output_file_name):
+def save_from_https(temp_path, output_file_name):
     """
-    Saves a file to the user's media collection
+    Saves a downloaded file to the user's media collection
+    The file was already streamed next to it, so it is moved into place atomically
     """
-    open(output_file_name, 'wb').write(media_content)
+    os.replace(temp_path, output_file_name)
 
 
 def create_file_name(args_dict, relevant_keys, audio_name, audio_ext):
@@ -162,47 +362,596 @@ def shaHashDigest(hashItem):
     return digest
 
 
-def isAudioBinaryValid(hashItem):
-    """
-    # Credit Yomichan for the idea, refactored the audio hashing system for use in python
-    Checks the audio binary and makes sure it isn't the JPod101 no-audio audio file
-    """
-    digest = shaHashDigest(hashItem)
-    if digest == 'ae6398b5a27bc8c0a771df6c907ade794be15518174773c58c7c7ddd17098906':    # Invalid audio file hash
-        return False
-    return True
-
-
 class AudioDownloader:
-    def __init__(self, audio_sources, mw):
+    def __init__(self, audio_sources, mw, source_settings=None, default_delay=0.0, pool_size=DEFAULT_POOL_SIZE,
+                 lookup_cache=None, dedupe_media=True, race_sources=1, fingerprints=None, metrics=None, media_dir=None,
+                 source_stats=None, adaptive_order=False, on_breaker_change=None, post_processor=None,
+                 pack_index_dir=None):
+        """
+        audio_sources is an ordered dict of source name -> URL
+        source_settings is an optional dict of source name -> extra options from the config (rate, burst, ...)
+        default_delay is the delay in seconds between lookups of sources that have no 'rate' configured, per host and
+            charged once per lookup (not for every request a lookup makes). Sources on this computer aren't delayed
+        pool_size is the amount of keep-alive connections kept open per host
+        lookup_cache is an optional LookupCache that is checked before querying a source, and closed along with this
+        dedupe_media makes byte-identical downloads reuse the file already in collection.media instead of saving a copy
+        race_sources is how many sources are queried at once for a single note, 1 tries them strictly one by one
+        fingerprints is an AudioFingerprints of known placeholder clips, each source's 'invalid_audio' gets added to it
+        metrics is the RunMetrics every request and lookup outcome is recorded in
+        media_dir is the folder audio is saved to when running outside of Anki (mw is None), instead of collection.media
+        source_stats is the SourceStats every network lookup is recorded in
+        adaptive_order tries the sources in the order source_stats expects to cost the least per hit,
+            after the sources that have 'pinned' set, instead of strictly in priority order
+        on_breaker_change(source name, state) is called whenever a source's circuit breaker opens or closes
+        post_processor is an optional PostProcessor every newly saved file is handed to, which decides their extension
+        pack_index_dir is the folder the indexes of sources with an 'audio_pack' are kept in, None rebuilds them in
+            memory every run
+        """
         self.audio_sources = audio_sources
+        # Source URLs are only parsed once per run
+        self.templates = {audio_name: UrlTemplate(raw_url) for audio_name, raw_url in audio_sources.items()}
         self.mw = mw
+        self.media_folder = media_dir
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.source_settings = source_settings or {}
+        self.pool_size = pool_size
+        self.lookup_cache = lookup_cache
+        self.source_stats = source_stats if source_stats is not None else SourceStats()
+        self.adaptive_order = adaptive_order
+        self.pinned = {audio_name for audio_name in audio_sources
+                       if self.source_settings.get(audio_name, {}).get('pinned')}
+        if fingerprints is None:
+            fingerprints = AudioFingerprints()
+            fingerprints.add(JPOD101_NO_AUDIO_SHA256)
+        self.fingerprints = fingerprints
+        for audio_name in self.audio_sources:
+            for fingerprint in self.source_settings.get(audio_name, {}).get('invalid_audio', []):
+                self.fingerprints.add(fingerprint, audio_name)
+        self.breakers = {}
+        for audio_name in self.audio_sources:
+            settings = self.source_settings.get(audio_name, {})
+            self.breakers[audio_name] = CircuitBreaker(audio_name,
+                                                       threshold=settings.get('breaker_threshold', DEFAULT_THRESHOLD),
+                                                       cooldown=settings.get('breaker_cooldown', DEFAULT_COOLDOWN),
+                                                       on_change=on_breaker_change)
+        # Connect and read timeouts per source, lowered to what each source actually needs as the run goes on
+        self.timeouts = {}
+        for audio_name in self.audio_sources:
+            settings = self.source_settings.get(audio_name, {})
+            self.timeouts[audio_name] = AdaptiveTimeout(
+                connect=settings.get('connect_timeout', DEFAULT_TIMEOUT),
+                read=settings.get('read_timeout', DEFAULT_TIMEOUT),
+                multiplier=settings.get('timeout_multiplier', DEFAULT_MULTIPLIER),
+                minimum=settings.get('min_timeout', DEFAULT_MIN_TIMEOUT))
+        self.media_index = MediaHashIndex(self.media_dir()) if dedupe_media else None
+        self.post_processor = post_processor
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.local = threading.local()
+        self.race_sources = max(1, int(race_sources))
+        self.race_executor = None
+        # Source name -> BatchLookup for the sources with a 'batch_url', filled in by prepare_batches
+        self.batches = {}
+        # Source name -> AudioPack for the sources that are a folder or zip file instead of a server
+        self.packs = {}
+        for audio_name in self.audio_sources:
+            settings = self.source_settings.get(audio_name, {})
+            if settings.get('audio_pack'):
+                self.packs[audio_name] = AudioPack(settings['audio_pack'], pack_index_dir,
+                                                   settings.get('pack_pattern', DEFAULT_PATTERN))
+        if self.race_sources > 1:
+            self.race_executor = ThreadPoolExecutor(max_workers=self.pool_size * self.race_sources,
+                                                    thread_name_prefix="batch_audio_race")
+
+        # Sources with a 'rate' throttle every request to their host. Sources without one (which includes every
+        #   source saved before 'rate' existed) keep the old delay, once per lookup instead of once per note
+        self.rate_limiter = HostRateLimiter()
+        self.delay_limiter = HostRateLimiter(1.0 / default_delay if default_delay > 0 else 0)
+        self.delayed_sources = set()
+        for audio_name, raw_url in self.audio_sources.items():
+            settings = self.source_settings.get(audio_name, {})
+            if 'rate' in settings:
+                self.rate_limiter.configure(get_host(raw_url), settings['rate'], settings.get('burst', 1))
+            elif not is_loopback(raw_url):
+                self.delayed_sources.add(audio_name)
+
+    def open_request(self, url, audio_name=None, allow_redirects=True, json_body=None, cancel_event=None):
+        """
+        Performs a streaming GET request (or POST, with a json_body) to the specified url once its host's rate limit
+            allows it
+        The source's timeouts are used, and how long it took to respond is fed back into them
+        Raises DownloadCancelled instead of sending the request if cancel_event is set while waiting on the limit
+        """
+        self.rate_limiter.acquire(url, cancel_event)
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled(url)
+        self.local.request_count = self.thread_request_count() + 1
+        self.metrics.record_request(audio_name)
+        timeout = self.timeouts.get(audio_name)
+        if timeout is None:
+            return open_request(url, allow_redirects, session=self.get_session(url), json_body=json_body)
+
+        started = time.monotonic()
+        try:
+            result = open_request(url, allow_redirects, session=self.get_session(url), timeout=timeout.get(),
+                                  json_body=json_body)
+        except requests.exceptions.Timeout:
+            timeout.timed_out()
+            raise
+        except ValueError as e:
+            # An error status is still a response
+            if hasattr(e, 'status_code'):
+                timeout.observe(time.monotonic() - started)
+            raise
+        timeout.observe(time.monotonic() - started)
+        return result
+
+    def current_timeouts(self):
+        """
+        Returns the (connect, read) timeouts every source is using at the moment
+        """
+        return {audio_name: timeout.get() for audio_name, timeout in self.timeouts.items()}
+
+    def thread_request_count(self):
+        """
+        Returns how many requests the calling thread has made so far
+        """
+        return getattr(self.local, 'request_count', 0)
+
+    def resolve_urls(self, args_dict, duplicate_fld):
+        """
+        Returns the substituted URL of every source for the args_dict, in priority order
+        Notes that resolve to the same URLs will always get the same audio
+        """
+        return tuple(template.render(args_dict, duplicate_fld)[0] for template in self.templates.values())
+
+    def prepare_batches(self, args_dicts, duplicate_fld):
+        """
+        Plans the batch lookups of every source that has a 'batch_url', for notes that will be downloaded in the
+            order of args_dicts
+        Each note is listed under the value of the source's 'batch_key' parameter (by default the first one in its
+            URL), notes without one are left to the source's per-note URL
+        """
+        self.batches = {}
+        for audio_name, template in self.templates.items():
+            settings = self.source_settings.get(audio_name, {})
+            if not settings.get('batch_url') or not template.placeholders:
+                continue
+            batch_key = settings.get('batch_key', template.placeholders[0]).lower()
+            batch = BatchLookup(lambda entries, audio_name=audio_name: self.fetch_batch(audio_name, entries),
+                                settings.get('batch_size', DEFAULT_BATCH_SIZE))
+            for args_dict in args_dicts:
+                try:
+                    get_url = template.render(args_dict, duplicate_fld)[0]
+                    entry = template.values(args_dict, duplicate_fld)
+                except Exception:
+                    continue
+                if entry.get(batch_key):
+                    batch.add(get_url, entry[batch_key], entry)
+            self.batches[audio_name] = batch
+
+    def fetch_batch(self, audio_name, entries):
+        """
+        Sends one batch lookup for a list of {parameter: value} entries to a source's 'batch_url'
+        With the 'POST' batch_method (the default) they are sent as {"terms": [entry, ...]}, with 'GET' as repeated
+            query parameters (?word=...&reading=...&word=...&reading=...)
+        Returns the answer, a JSON object of term -> URL, list of URLs, or anything extract_urls finds URLs in
+        """
+        settings = self.source_settings.get(audio_name, {})
+        batch_url = settings['batch_url']
+        if settings.get('batch_method', DEFAULT_BATCH_METHOD).upper() == 'GET':
+            query = urlencode([(name, value) for entry in entries for name, value in entry.items()])
+            response, _, _ = self.open_request(batch_url + ('&' if '?' in batch_url else '?') + query, audio_name)
+        else:
+            response, _, _ = self.open_request(batch_url, audio_name, json_body={'terms': entries})
+        payload = read_response(response, BATCH_MAX_JSON_SIZE)
+        self.metrics.record_bytes(audio_name, len(payload))
+        answer = json.loads(payload)
+        if not isinstance(answer, dict):
+            raise ValueError("Batch lookup answer for %s isn't a JSON object" % audio_name)
+        return answer
+
+    def source_order(self):
+        """
+        Returns the source names in the order they should be tried for the next note
+        """
+        if self.adaptive_order:
+            return self.source_stats.order(self.templates, self.pinned)
+        return self.templates
+
+    def load_packs(self):
+        """
+        Builds the index of every audio pack source that doesn't have an up to date one yet
+        A pack that can't be read is left alone, its lookups fail and the next source is tried instead
+        """
+        for pack in self.packs.values():
+            try:
+                pack.load()
+            except (OSError, sqlite3.Error):
+                pass
+
+    def open_breakers(self):
+        """
+        Returns the names of the sources that are currently being skipped
+        """
+        return [audio_name for audio_name, breaker in self.breakers.items() if not breaker.is_closed()]
 
-    def download_single(self, args_dict, duplicate_fld):
+    def media_dir(self):
+        if self.media_folder:
+            return self.media_folder
+        return self.mw.col.media.dir()
+
+    def get_session(self, url):
+        """
+        Returns the pooled session for the url's host, creating it on first use
+        """
+        host = get_host(url)
+        with self.sessions_lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = create_session(self.pool_size)
+            return session
+
+    def close(self):
+        """
+        Closes every pooled session and the connections they kept alive, along with the lookup cache
+        Waits for the post processor to finish every file it was handed
+        """
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+        if self.race_executor:
+            # Raced downloads that lost are already aborted, waiting on them makes sure they are cleaned up before
+            #   the lookup cache is closed
+            self.race_executor.shutdown(wait=True, cancel_futures=True)
+
+        if self.lookup_cache:
+            self.lookup_cache.close()
+            self.lookup_cache = None
+
+        for pack in self.packs.values():
+            pack.close()
+
+        if self.post_processor:
+            self.post_processor.close()
+
+    def saved_file_name(self, file_name, wait=True):
+        """
+        Returns the name a file from download_single ends up with in collection.media, which is only known once the
+            post processor is done with it (a clip it doesn't convert keeps the extension it was downloaded with)
+        Without wait, None is returned instead while the post processor is still working on the file
+        """
+        return self.post_processor.final_name(file_name, wait) if self.post_processor else file_name
+
+    def download_single(self, args_dict, duplicate_fld, log=None, retry_state=None, cancel_event=None):
         """
         Downloads an audio file based on the args_dict,
             saves it to the user's collection.media,
             and returns the file name.
+        If a log list is given, (source name, outcome) is appended for every source tried, where the outcome is
+            'hit', 'miss', or the name of the error that occurred
+        If a RetryState is given, a source that fails for a moment raises RetryLater (see retry_source) instead of
+            falling back to the next source, and the sources it already finished with are skipped on the next try
+        Once cancel_event is set, the download in flight is aborted and DownloadCancelled is raised instead of trying
+            any other source
         """
+        attempts = []
+        for audio_name in self.source_order():
+            if retry_state and audio_name in retry_state.done:
+                continue
+            try:
+                get_url, relevant_keys = self.templates[audio_name].render(args_dict, duplicate_fld)
+                attempts.append((audio_name, get_url, relevant_keys))
+            except Exception:
+                pass
+
+        if log is None:
+            log = []
+        if self.race_sources > 1:
+            return self.race_attempts(attempts, args_dict, log, retry_state, cancel_event)
+
         # try each in order, if result is nothing or error occurs try next
-        for audio_name, raw_url in self.audio_sources.items():
+        for audio_name, get_url, relevant_keys in attempts:
+            if cancel_event is not None and cancel_event.is_set():
+                raise DownloadCancelled(audio_name)
             try:
-                get_url, relevant_keys = substitute_string_vars(raw_url, args_dict, duplicate_fld)
-                request_payload, is_json, audio_ext = get_request(get_url)
-                if is_json:
-                    json_dict_payload = json.loads(request_payload)
-                    download_url = filter_urls_dict(json_dict_payload)
-                    request_payload, _, audio_ext = get_request(download_url)
-
-                if not isAudioBinaryValid(request_payload):
-                    continue
+                fetched = self.fetch_from_source(audio_name, get_url, cancel_event)
+                if fetched:
+                    audio_filename = self.keep_fetched(audio_name, get_url, fetched, args_dict, relevant_keys)
+                    log.append((audio_name, OUTCOME_HIT))
+                    return audio_filename
+                log.append((audio_name, OUTCOME_MISS))
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                log.append((audio_name, type(e).__name__))
+                self.retry_source(audio_name, e, retry_state)
+            if retry_state:
+                retry_state.done.add(audio_name)
 
-                output_file_name = create_file_name(args_dict, relevant_keys, audio_name, audio_ext)
-                full_output_file_name = os.path.join(self.mw.col.media.dir(), output_file_name)
-                save_from_https(request_payload, full_output_file_name)
+        return None
 
-                return output_file_name
+    def retry_source(self, audio_name, error, retry_state):
+        """
+        Raises RetryLater if the error is worth retrying and the source has retries left for this note
+        The source's 'max_retries' and 'retry_backoff' settings decide how often and how soon
+        """
+        if retry_state is None or not is_retryable(error):
+            return
+        settings = self.source_settings.get(audio_name, {})
+        retries = retry_state.retries.get(audio_name, 0)
+        if retries >= settings.get('max_retries', DEFAULT_MAX_RETRIES):
+            return
+        delay = retry_delay(error, retries, settings.get('retry_backoff', DEFAULT_BACKOFF))
+        if delay is None:
+            return
+        retry_state.retries[audio_name] = retries + 1
+        self.metrics.record_retry(audio_name)
+        raise RetryLater(audio_name, delay)
+
+    def race_attempts(self, attempts, args_dict, log, retry_state=None, run_cancel_event=None):
+        """
+        Queries up to race_sources sources at once and keeps the highest priority one that has the audio
+        A source only wins once every source above it has missed, so the result is the same as trying them in order
+        Once there is a winner, or run_cancel_event is set, the downloads still running for lower priority sources
+            are aborted
+        """
+        cancel_event = ChildEvent(run_cancel_event)
+        futures = []
+        next_attempt = 0
+        try:
+            for head, (audio_name, get_url, relevant_keys) in enumerate(attempts):
+                # Keep the window of running attempts full, starting from the highest priority one still pending
+                while next_attempt < len(attempts) and next_attempt - head < self.race_sources:
+                    futures.append(self.race_executor.submit(
+                        self._race_task, attempts[next_attempt][0], attempts[next_attempt][1], cancel_event))
+                    next_attempt += 1
+
+                fetched, error, request_count = futures[head].result()
+                self.local.request_count = self.thread_request_count() + request_count
+                if isinstance(error, DownloadCancelled):
+                    raise error
+                if error:
+                    log.append((audio_name, type(error).__name__))
+                    self.retry_source(audio_name, error, retry_state)
+                elif not fetched:
+                    log.append((audio_name, OUTCOME_MISS))
+                else:
+                    futures[head] = None
+                    try:
+                        audio_filename = self.keep_fetched(audio_name, get_url, fetched, args_dict, relevant_keys)
+                    except Exception as e:
+                        # Same as trying the sources one by one: the source is done with, unless it is retried
+                        log.append((audio_name, type(e).__name__))
+                        self.retry_source(audio_name, e, retry_state)
+                    else:
+                        log.append((audio_name, OUTCOME_HIT))
+                        return audio_filename
+                if retry_state:
+                    retry_state.done.add(audio_name)
+        finally:
+            cancel_event.set()
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+                    future.add_done_callback(discard_race_result)
+
+        return None
+
+    def _race_task(self, audio_name, get_url, cancel_event):
+        """
+        Runs fetch_from_source on a race thread
+        Returns the FetchedAudio (or None), the error if there was one, and how many requests were made
+        """
+        before = self.thread_request_count()
+        try:
+            fetched, error = self.fetch_from_source(audio_name, get_url, cancel_event), None
+        except Exception as e:
+            fetched, error = None, e
+        return fetched, error, self.thread_request_count() - before
+
+    def fetch_from_source(self, audio_name, get_url, cancel_event=None):
+        """
+        Checks the lookup cache, then downloads the audio for an already substituted source URL to a temporary file
+        Returns a FetchedAudio, or None if the source has no audio for it
+        Any other failure (timeouts, server errors, ...) is raised so that it doesn't get cached as a miss
+        The outcome and latency of every lookup is recorded in the run's metrics and, unless it came from the lookup
+            cache, in the source statistics and the source's circuit breaker
+        A CircuitOpen error is raised without a request if the source's breaker is open
+        """
+        breaker = self.breakers[audio_name]
+        started = time.monotonic()
+        requests_before = self.thread_request_count()
+        try:
+            fetched, outcome = self._fetch_from_source(audio_name, get_url, cancel_event)
+        except CircuitOpen:
+            self.metrics.record_outcome(audio_name, CircuitOpen.__name__)
+            raise
+        except DownloadCancelled:
+            breaker.record_other()
+            raise
+        except Exception as e:
+            latency = time.monotonic() - started
+            if is_breaker_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_other()
+            self.metrics.record_outcome(audio_name, type(e).__name__, latency)
+            self.source_stats.record(audio_name, False, latency, self.thread_request_count() - requests_before)
+            raise
+
+        if outcome in (OUTCOME_CACHED_HIT, OUTCOME_CACHED_MISS):
+            self.metrics.record_outcome(audio_name, outcome)
+        else:
+            latency = time.monotonic() - started
+            breaker.record_success()
+            self.metrics.record_outcome(audio_name, outcome, latency)
+            self.source_stats.record(audio_name, outcome == OUTCOME_HIT, latency,
+                                     self.thread_request_count() - requests_before)
+        return fetched
+
+    def _fetch_from_source(self, audio_name, get_url, cancel_event):
+        """
+        Does the work for fetch_from_source, returning the FetchedAudio (or None) along with the outcome
+        """
+        if self.lookup_cache:
+            cached = self.lookup_cache.get(audio_name, get_url)
+            if cached is MISS:
+                return None, OUTCOME_CACHED_MISS
+            if cached:
+                if os.path.exists(os.path.join(self.media_dir(), cached[0])):
+                    return FetchedAudio(file_name=cached[0], digest=cached[1]), OUTCOME_CACHED_HIT
+                self.lookup_cache.forget(audio_name, get_url)
+
+        pack = self.packs.get(audio_name)
+        if pack:
+            return self.fetch_from_pack(audio_name, get_url, pack)
+
+        if not self.breakers[audio_name].allow():
+            raise CircuitOpen(audio_name)
+
+        # A batch source answers from the batch its note was sent in, unless that batch failed
+        batch = self.batches.get(audio_name)
+        if batch and batch.covers(get_url):
+            try:
+                listed = batch.lookup(get_url)
             except Exception:
                 pass
+            else:
+                candidates = [listed] if isinstance(listed, str) else extract_urls(listed, '*')
+                if not candidates:
+                    return self.record_miss(audio_name, get_url), OUTCOME_MISS
+                return self.try_candidates(audio_name, get_url, candidates, cancel_event)
+
+        settings = self.source_settings.get(audio_name, {})
+        if audio_name in self.delayed_sources and not self.delay_limiter.acquire(get_url, cancel_event):
+            raise DownloadCancelled(get_url)
+        try:
+            response, is_json, audio_ext = self.open_request(get_url, audio_name, cancel_event=cancel_event)
+        except ValueError as e:
+            if getattr(e, 'status_code', None) in MISS_STATUS_CODES:
+                return self.record_miss(audio_name, get_url), OUTCOME_MISS
+            raise
+
+        if not is_json:
+            # A page that isn't audio (like a bot check) raises NotAudio here, so it is an error instead of a miss: it
+            #   isn't cached and doesn't count as the source answering
+            fetched, outcome = self.download_candidate(audio_name, get_url, response, audio_ext, cancel_event)
+            if not fetched:
+                self.record_miss(audio_name, get_url)
+            return fetched, outcome
+
+        # A JSON source (like a local audio server) usually lists several candidates, each one is tried in turn
+        #   before giving up on the source, so the JSON only has to be fetched once
+        json_payload = read_response(response, DEFAULT_MAX_JSON_SIZE)
+        self.metrics.record_bytes(audio_name, len(json_payload))
+        candidates = extract_urls(json.loads(json_payload), settings.get('json_path'))
+        return self.try_candidates(audio_name, get_url, candidates, cancel_event)
+
+    def fetch_from_pack(self, audio_name, get_url, pack):
+        """
+        Looks a note up in a source's audio pack, the word and reading are the 'pack_term' and 'pack_reading'
+            parameters of its URL ('term' and 'reading' by default), which is never requested
+        Returns the FetchedAudio (or None) along with the outcome
+        """
+        settings = self.source_settings.get(audio_name, {})
+        params = parse_qs(urlsplit(get_url).query, keep_blank_values=True)
+        term = params.get(settings.get('pack_term', 'term'), [''])[0]
+        reading = params.get(settings.get('pack_reading', 'reading'), [''])[0]
+        path = pack.find(term, reading)
+        if path is None:
+            return self.record_miss(audio_name, get_url), OUTCOME_MISS
+
+        temp_path, digest, size = pack.copy_to(path, self.media_dir())
+        self.metrics.record_bytes(audio_name, size)
+        return FetchedAudio(temp_path=temp_path, digest=digest, size=size,
+                            audio_ext=os.path.splitext(path)[1].lower()), OUTCOME_HIT
+
+    def try_candidates(self, audio_name, get_url, candidates, cancel_event=None):
+        """
+        Tries up to the source's 'max_candidates' audio URLs in order, returning the first usable FetchedAudio (or
+            None) along with the outcome
+        If none of them had the audio but one of them failed, the failure is raised instead of recording a miss
+        """
+        settings = self.source_settings.get(audio_name, {})
+        outcome = OUTCOME_MISS
+        error = None
+        for candidate_url in candidates[:settings.get('max_candidates', DEFAULT_MAX_CANDIDATES)]:
+            try:
+                response, _, audio_ext = self.open_request(candidate_url, audio_name, cancel_event=cancel_event)
+                fetched, candidate_outcome = self.download_candidate(audio_name, get_url, response, audio_ext,
+                                                                     cancel_event)
+            except DownloadCancelled:
+                raise
+            except NotAudio:
+                # The source listed it, so a candidate that turns out not to be audio is just missing
+                continue
+            except Exception as e:
+                if getattr(e, 'status_code', None) not in MISS_STATUS_CODES:
+                    error = e
+                continue
+            if fetched:
+                return fetched, OUTCOME_HIT
+            if candidate_outcome == OUTCOME_PLACEHOLDER:
+                outcome = OUTCOME_PLACEHOLDER
+
+        # Only remember the miss if every candidate really was missing, not if one of them failed
+        if error:
+            raise error
+        return self.record_miss(audio_name, get_url), outcome
+
+    def download_candidate(self, audio_name, get_url, response, audio_ext, cancel_event=None):
+        """
+        Streams an opened audio response to a temporary file and checks it against the placeholder fingerprints
+        Returns the FetchedAudio (or None if it is a placeholder) along with the outcome
+        Raises NotAudio if the response turns out not to be audio at all
+        """
+        max_size = self.source_settings.get(audio_name, {}).get('max_size', DEFAULT_MAX_SIZE)
+        temp_path, digest, size, head = stream_to_file(response, self.media_dir(), max_size, cancel_event)
+        self.metrics.record_bytes(audio_name, size)
 
+        if self.fingerprints.is_placeholder(audio_name, size, head, digest) or \
+                self.fingerprints.observe(audio_name, self.templates[audio_name].parse(get_url), size, head, digest):
+            os.remove(temp_path)
+            return None, OUTCOME_PLACEHOLDER
+
+        return FetchedAudio(temp_path=temp_path, digest=digest, size=size, audio_ext=audio_ext), OUTCOME_HIT
+
+    def record_miss(self, audio_name, get_url):
+        if self.lookup_cache:
+            self.lookup_cache.put(audio_name, get_url)
         return None
+
+    def keep_fetched(self, audio_name, get_url, fetched, args_dict, relevant_keys):
+        """
+        Saves a fetched download to the user's collection.media (unless an identical file is already there)
+        Returns the file name the note should reference
+        """
+        if fetched.file_name:
+            return fetched.file_name
+
+        temp_path = fetched.temp_path
+        try:
+            # Reference the identical file if this exact clip was already saved, for this or any other note
+            output_file_name = self.media_index.find(fetched.digest, fetched.size) if self.media_index else None
+            if not output_file_name:
+                audio_ext = self.post_processor.extension if self.post_processor else fetched.audio_ext
+                output_file_name = create_file_name(args_dict, relevant_keys, audio_name, audio_ext)
+                full_output_file_name = os.path.join(self.media_dir(), output_file_name)
+                save_from_https(temp_path, full_output_file_name)
+                temp_path = None
+                if self.post_processor:
+                    self.post_processor.submit(full_output_file_name, os.path.join(
+                        self.media_dir(), create_file_name(args_dict, relevant_keys, audio_name, fetched.audio_ext)))
+                if self.media_index:
+                    self.media_index.add(output_file_name, fetched.digest)
+        finally:
+            if temp_path:
+                os.remove(temp_path)
+
+        if self.lookup_cache:
+            self.lookup_cache.put(audio_name, get_url, output_file_name, fetched.digest)
+        return output_file_name
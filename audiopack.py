@@ -0,0 +1,236 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles sources that are a folder or zip file of audio on this computer (an audio pack),
+                    instead of a server.
+                The first time a pack is used, every audio file in it is indexed by its normalised word and reading in
+                    an SQLite file, which is kept until the pack changes. Each note is then a single index lookup, and
+                    the file is hard linked (or copied) into collection.media without any HTTP in between.
+"""
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unicodedata
+import zipfile
+
+from .mediaindex import TEMP_FILE_PREFIX
+
+INDEX_VERSION = 1
+AUDIO_EXTENSIONS = ('.mp3', '.ogg', '.opus', '.oga', '.m4a', '.aac', '.wav', '.flac')
+# Matched against each file's path inside the pack, without its extension and with / between folders
+# By default a file is named after its word, optionally with the reading in front like "reading - word"
+DEFAULT_PATTERN = r'(?:^|/)(?:(?P<reading>[^/]+?) - )?(?P<term>[^/]+)$'
+COPY_CHUNK_SIZE = 64 * 1024
+INSERT_BATCH = 10000
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+
+
+def normalize_term(term):
+    return unicodedata.normalize('NFKC', term).strip().casefold()
+
+
+def normalize_reading(reading):
+    """
+    Readings match whether they are written in hiragana or katakana, full or half width
+    """
+    return ''.join(unicodedata.normalize('NFKC', reading).split()).translate(KATAKANA_TO_HIRAGANA)
+
+
+class AudioPack:
+    def __init__(self, path, index_dir=None, pattern=DEFAULT_PATTERN):
+        """
+        path is the pack's folder or zip file
+        index_dir is the folder the pack's index is kept in between runs, None keeps it in memory for this run only
+        pattern is a regex with 'term' and (optionally) 'reading' groups, see DEFAULT_PATTERN
+        """
+        self.path = os.path.abspath(path)
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.index_dir = index_dir
+        self.lock = threading.Lock()
+        self.db = None
+        self.local = threading.local()
+        self.archives = []
+
+    def index_path(self):
+        key = hashlib.sha1((self.path + '\n' + self.pattern).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.index_dir, key + '.sqlite')
+
+    def is_zip(self):
+        return os.path.isfile(self.path)
+
+    def signature(self):
+        """
+        Changes whenever the pack does, for a folder that is whenever it or one of its direct subfolders changes
+        """
+        parts = [str(INDEX_VERSION), self.pattern]
+        if self.is_zip():
+            stat = os.stat(self.path)
+            parts += [str(stat.st_size), str(stat.st_mtime_ns)]
+        else:
+            parts.append(str(os.stat(self.path).st_mtime_ns))
+            with os.scandir(self.path) as entries:
+                parts += sorted(entry.name + ':' + str(entry.stat().st_mtime_ns) for entry in entries
+                                if entry.is_dir())
+        return '\n'.join(parts)
+
+    def files(self):
+        """
+        Yields the path inside the pack of every audio file in it
+        """
+        if self.is_zip():
+            with zipfile.ZipFile(self.path) as archive:
+                for name in archive.namelist():
+                    if name.lower().endswith(AUDIO_EXTENSIONS):
+                        yield name
+            return
+        for root, _, names in os.walk(self.path):
+            relative_root = os.path.relpath(root, self.path).replace(os.sep, '/')
+            for name in names:
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    yield name if relative_root == '.' else relative_root + '/' + name
+
+    def rows(self):
+        for path in self.files():
+            match = self.regex.search(os.path.splitext(path)[0])
+            if match and match.group('term'):
+                reading = match.groupdict().get('reading') or ''
+                yield normalize_term(match.group('term')), normalize_reading(reading), path
+
+    def build(self, db):
+        signature = self.signature()
+        db.execute("CREATE TABLE files (term TEXT NOT NULL, reading TEXT NOT NULL, path TEXT NOT NULL)")
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        rows = self.rows()
+        while True:
+            batch = [row for _, row in zip(range(INSERT_BATCH), rows)]
+            if not batch:
+                break
+            db.executemany("INSERT INTO files VALUES (?, ?, ?)", batch)
+        db.execute("CREATE INDEX files_term ON files (term, reading)")
+        db.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        db.commit()
+
+    def open(self):
+        """
+        Opens the pack's index, building it first if there is none yet or the pack changed since
+        Must be called while holding the lock
+        """
+        if self.index_dir is None:
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+            self.build(self.db)
+            return
+
+        index_path = self.index_path()
+        if os.path.exists(index_path):
+            db = sqlite3.connect(index_path, check_same_thread=False)
+            try:
+                row = db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            except sqlite3.DatabaseError:
+                row = None
+            if row and row[0] == self.signature():
+                self.db = db
+                return
+            db.close()
+
+        # Built next to where it goes and moved into place, so runs in other processes never see half an index
+        os.makedirs(self.index_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, suffix='.sqlite', dir=self.index_dir)
+        os.close(fd)
+        try:
+            db = sqlite3.connect(temp_path)
+            try:
+                self.build(db)
+            finally:
+                db.close()
+            os.replace(temp_path, index_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+
+    def load(self):
+        """
+        Opens (or builds) the index now, instead of on the first lookup
+        """
+        with self.lock:
+            if self.db is None:
+                self.open()
+
+    def find(self, term, reading=''):
+        """
+        Returns the path inside the pack of the audio for a word, or None if the pack has none
+        A file with the same reading is preferred, then one without a reading. Without a reading any file for the
+            word will do
+        """
+        term = normalize_term(term)
+        reading = normalize_reading(reading)
+        if not term:
+            return None
+        with self.lock:
+            if self.db is None:
+                self.open()
+            if reading:
+                row = self.db.execute("SELECT path FROM files WHERE term = ? AND reading IN (?, '') "
+                                      "ORDER BY reading = '', path LIMIT 1", (term, reading)).fetchone()
+            else:
+                row = self.db.execute("SELECT path FROM files WHERE term = ? ORDER BY path LIMIT 1",
+                                      (term,)).fetchone()
+        return row[0] if row else None
+
+    def archive(self):
+        """
+        Returns this thread's handle on the zip file
+        """
+        archive = getattr(self.local, 'archive', None)
+        if archive is None:
+            archive = self.local.archive = zipfile.ZipFile(self.path)
+            with self.lock:
+                self.archives.append(archive)
+        return archive
+
+    def copy_to(self, path, directory):
+        """
+        Puts a file of the pack in a temporary file in the directory, as a hard link when it can
+        Returns the temporary file's path and the file's SHA-256 digest and size
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, suffix='.part', dir=directory)
+        try:
+            if self.is_zip():
+                with os.fdopen(fd, 'wb') as f, self.archive().open(path) as source:
+                    shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+            else:
+                os.close(fd)
+                source_path = os.path.join(self.path, *path.split('/'))
+                os.remove(temp_path)
+                try:
+                    os.link(source_path, temp_path)
+                except OSError:
+                    # Another drive, or a file system without hard links
+                    shutil.copyfile(source_path, temp_path)
+
+            m = hashlib.sha256()
+            size = 0
+            with open(temp_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    m.update(chunk)
+                    size += len(chunk)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return temp_path, m.hexdigest(), size
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            for archive in self.archives:
+                archive.close()
+            self.archives.clear()
@@ -0,0 +1,71 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles sources that can look up many terms in a single request, like a self-hosted audio
+                    server with a batch endpoint.
+                Before a run, the notes' lookups for such a source are split into chunks in the order the notes will be
+                    downloaded. The first note that needs a chunk sends its batch request, notes from the same chunk
+                    wait on that one request, and every later note of the chunk reuses its answer.
+"""
+import threading
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_METHOD = 'POST'
+
+
+class BatchChunk:
+    __slots__ = ('entries', 'lock', 'answer', 'error')
+
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+        self.answer = None
+        self.error = None
+
+
+class BatchLookup:
+    def __init__(self, fetch, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        fetch(entries) sends one batch request for a list of entries ({placeholder: value} dicts) and returns the
+            answer, a dict of key -> whatever the source lists for it
+        batch_size is the most entries sent in one request
+        """
+        self.fetch = fetch
+        self.batch_size = max(1, int(batch_size))
+        self.chunks = []
+        self.by_url = {}
+
+    def add(self, get_url, key, entry):
+        """
+        Plans the lookup of a note, get_url is the note's per-note URL for the source and key what the answer lists
+            it under
+        Notes are sent in the order they are added, notes with the same URL are only sent once
+        """
+        if get_url in self.by_url:
+            return
+        if not self.chunks or len(self.chunks[-1].entries) >= self.batch_size:
+            self.chunks.append(BatchChunk())
+        chunk = self.chunks[-1]
+        chunk.entries.append(entry)
+        self.by_url[get_url] = (chunk, key)
+
+    def covers(self, get_url):
+        return get_url in self.by_url
+
+    def lookup(self, get_url):
+        """
+        Returns what the answer of the note's chunk lists for it (None if nothing), sending the chunk's batch
+            request first if no note of the chunk has yet
+        Raises the batch request's error if it failed, for every note of the chunk
+        """
+        chunk, key = self.by_url[get_url]
+        with chunk.lock:
+            if chunk.answer is None and chunk.error is None:
+                try:
+                    chunk.answer = self.fetch(chunk.entries)
+                except Exception as e:
+                    chunk.error = e
+        if chunk.error is not None:
+            raise chunk.error
+        return chunk.answer.get(key)
@@ -0,0 +1,24 @@
+"""
+Loads the addon's modules outside of Anki
+
+The addon folder is a package whose __init__ imports aqt, so it is registered under a fixed name without running
+    __init__, which lets its Anki-independent modules (audiodownloader, pipeline, ...) be imported on their own
+"""
+import importlib
+import os
+import sys
+import types
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = 'generate_batch_audio'
+
+
+def load(module_name):
+    """
+    Imports and returns one of the addon's modules, e.g. load('audiodownloader')
+    """
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [ADDON_DIR]
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(PACKAGE_NAME + '.' + module_name)
@@ -0,0 +1,226 @@
+"""
+Benchmark for AudioDownloader and the note pipeline, against the local stub server instead of real sites
+
+Usage: python benchmarks/bench_pipeline.py [--notes 2000] [--workers 8] [--race 1] [--scenario local]
+                                           [--duplicates 0.1] [--latency route=median_ms[:sigma]] [--cache] [--adaptive]
+                                           [--fixed-timeouts] [--no-retry]
+                                           [--stub-url http://127.0.0.1:5050]
+
+The stub server runs in this process unless --stub-url points at one started with stub_server.py, which keeps
+it from competing with the workers for the GIL (--latency only applies to the in-process stub).
+
+Reports notes/sec, p50/p99 latency per note, peak memory and the per-source summary of the run.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+from _addon import load
+from stub_server import start_stub_server, Route, DEFAULT_ROUTES, PLACEHOLDER_CLIP, audio_for
+
+audiodownloader = load('audiodownloader')
+pipeline = load('pipeline')
+fingerprints = load('fingerprints')
+lookupcache = load('lookupcache')
+
+SCENARIOS = {
+    # Like a couple of sources on the local audio server
+    'local': ['json', 'direct'],
+    # Every kind of source, in a realistic (bad) priority order
+    'mixed': ['missing', 'placeholder', 'json', 'busy', 'direct', 'slow'],
+    'slow': ['slow', 'direct'],
+    # A source that sometimes hangs, with a reliable one behind it
+    'flaky': ['flaky', 'direct'],
+    # A source that turns every note away once before answering, with a backup behind it
+    'hiccup': ['hiccup', 'direct'],
+    # The local audio server answering many notes per request, against 'local'
+    'batch': ['batch', 'direct'],
+    # The same audio as 'local' in a folder on disk, looked up without any HTTP
+    'pack': ['pack', 'direct'],
+}
+# Sources that look their notes up in batches, and the route they fall back to for a single note
+BATCH_SOURCES = {'batch': 'json'}
+# Sources that are an audio pack with the same audio as a route
+PACK_SOURCES = {'pack': 'json'}
+
+
+class FakeMedia:
+    def __init__(self, media_dir):
+        self.media_dir = media_dir
+
+    def dir(self):
+        return self.media_dir
+
+
+class FakeCollection:
+    """
+    Just enough of a collection for AudioDownloader, plus a dict of note fields the pipeline writes to
+    """
+    def __init__(self, media_dir):
+        self.media = FakeMedia(media_dir)
+        self.notes = {}
+
+
+class FakeMw:
+    def __init__(self, col):
+        self.col = col
+
+
+def make_notes(count, duplicates):
+    """
+    Returns {nid: fields}, with roughly `duplicates` of the notes repeating an earlier word
+    """
+    notes = {}
+    unique = max(1, int(count * (1 - duplicates)))
+    for i in range(count):
+        word = 'word%d' % (i if i < unique else i % unique)
+        notes[1000 + i] = {'Word': word, 'Reading': 'reading' + word[4:], 'Audio': ''}
+    return notes
+
+
+def make_pack(pack_dir, notes, route):
+    """
+    Writes the audio the route has for the notes' words to a folder, as "reading - word.mp3" files
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    for fields in notes.values():
+        if route.has(fields['Word']):
+            with open(os.path.join(pack_dir, '%s - %s.mp3' % (fields['Reading'], fields['Word'])), 'wb') as f:
+                f.write(audio_for(fields['Word'], fields['Reading']))
+    return pack_dir
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def parse_latency(specs):
+    routes = {}
+    for spec in specs:
+        name, value = spec.split('=')
+        median, _, sigma = value.partition(':')
+        base = DEFAULT_ROUTES[name]
+        routes[name] = Route(float(median) / 1000.0, float(sigma) if sigma else base.sigma, base.hit_rate)
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--race', type=int, default=1)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='local')
+    parser.add_argument('--duplicates', type=float, default=0.1)
+    parser.add_argument('--latency', action='append', default=[])
+    parser.add_argument('--cache', action='store_true', help="use a (fresh) lookup cache")
+    parser.add_argument('--adaptive', action='store_true', help="use adaptive source ordering")
+    parser.add_argument('--fixed-timeouts', action='store_true', help="don't adapt the timeouts to the sources")
+    parser.add_argument('--no-retry', action='store_true', help="fall back to the next source instead of retrying")
+    parser.add_argument('--stub-url', help="use a stub server that is already running")
+    args = parser.parse_args()
+
+    if args.stub_url:
+        server, base_url = None, args.stub_url.rstrip('/')
+    else:
+        server, base_url = start_stub_server(routes=parse_latency(args.latency))
+    work_dir = tempfile.mkdtemp(prefix='batch_audio_bench_')
+    media_dir = os.path.join(work_dir, 'collection.media')
+    os.makedirs(media_dir)
+
+    try:
+        col = FakeCollection(media_dir)
+        col.notes = make_notes(args.notes, args.duplicates)
+        routes = {name: BATCH_SOURCES.get(name, PACK_SOURCES.get(name, name)) for name in SCENARIOS[args.scenario]}
+        audio_sources = {name: base_url + '/' + route + '?term={word}&reading={reading}'
+                         for name, route in routes.items()}
+        source_settings = {name: {'rate': 0} for name in audio_sources}
+        for name in audio_sources:
+            if name in BATCH_SOURCES:
+                source_settings[name]['batch_url'] = base_url + '/' + name
+            if name in PACK_SOURCES:
+                source_settings[name]['audio_pack'] = make_pack(os.path.join(work_dir, name), col.notes,
+                                                                DEFAULT_ROUTES[routes[name]])
+        if args.fixed_timeouts:
+            for settings in source_settings.values():
+                settings['timeout_multiplier'] = 0
+        if args.no_retry:
+            for settings in source_settings.values():
+                settings['max_retries'] = 0
+        known = fingerprints.AudioFingerprints(learn_threshold=0)
+        known.add(audiodownloader.shaHashDigest(PLACEHOLDER_CLIP))
+        cache = lookupcache.LookupCache(os.path.join(work_dir, 'cache.sqlite')) if args.cache else None
+        ad = audiodownloader.AudioDownloader(audio_sources, FakeMw(col), source_settings, pool_size=args.workers,
+                                             lookup_cache=cache, race_sources=args.race, fingerprints=known,
+                                             adaptive_order=args.adaptive,
+                                             pack_index_dir=os.path.join(work_dir, 'pack_index'))
+        if ad.packs:
+            started = time.perf_counter()
+            ad.load_packs()
+            print("indexed packs in %.2f s" % (time.perf_counter() - started))
+
+        # Time every download from the worker that runs it
+        latencies = []
+        latencies_lock = threading.Lock()
+        download_single = ad.download_single
+
+        def timed_download_single(*a, **kw):
+            started = time.perf_counter()
+            try:
+                return download_single(*a, **kw)
+            finally:
+                with latencies_lock:
+                    latencies.append(time.perf_counter() - started)
+
+        ad.download_single = timed_download_single
+
+        jobs = [pipeline.DownloadJob(nid, dict(fields)) for nid, fields in col.notes.items()]
+
+        def on_result(job, audio_filename, log):
+            if audio_filename:
+                col.notes[job.nid]['Audio'] = '[sound:' + audio_filename + ']'
+
+        started = time.perf_counter()
+        runner = pipeline.DownloadPipeline(ad, True, max_workers=args.workers)
+        finished, _ = runner.run(jobs, on_result)
+        elapsed = time.perf_counter() - started
+        # tracemalloc would slow down the run it measures, the peak resident size (KB on Linux) is free
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+        ad.close()
+
+        filled = sum(1 for fields in col.notes.values() if fields['Audio'])
+        print("scenario %s, %d notes, %d workers, race %d%s" % (args.scenario, args.notes, args.workers, args.race,
+                                                                ', adaptive' if args.adaptive else ''))
+        print("notes/sec:       %10.1f" % (finished / elapsed))
+        print("elapsed:         %10.2f s" % elapsed)
+        print("notes with audio:%10d" % filled)
+        print("coalesced notes: %10d (saved %d requests)" % (runner.coalesced_notes, runner.requests_saved))
+        print("retries:         %10d" % runner.retries)
+        print("p50 per note:    %10.1f ms" % (percentile(latencies, 50) * 1000))
+        print("p99 per note:    %10.1f ms" % (percentile(latencies, 99) * 1000))
+        print("mean per note:   %10.1f ms" % (statistics.mean(latencies) * 1000 if latencies else 0))
+        print("peak RSS:        %10.1f MB" % (peak_memory / 1024.0 / 1024.0))
+        print()
+        print("%-12s %8s %6s %6s %6s %6s %8s %8s %8s" % ('source', 'requests', 'hits', 'misses', 'placeh', 'errors',
+                                                        'p50 ms', 'p95 ms', 'MB'))
+        for row in ad.metrics.summary_rows():
+            print("%-12s %8s %6s %6s %6s %6s %8s %8s %8s" % row)
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
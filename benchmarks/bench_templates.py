@@ -0,0 +1,48 @@
+"""
+Microbenchmark for rendering source URLs from note fields
+
+Usage: python benchmarks/bench_templates.py [iterations]
+"""
+import sys
+import timeit
+
+from _addon import load
+
+urltemplate = load('urltemplate')
+
+TEMPLATES = [
+    "http://127.0.0.1:5050/?sources=nhk16&term={word}&reading={reading}",
+    "http://127.0.0.1:5050/?sources=shinmeikai8&term={word}&reading={reading}",
+    "https://assets.languagepod101.com/dictionary/japanese/audiomp3.php?kanji={word}&kana={reading}",
+    "http://127.0.0.1:8770/?expression={Word}&reading={READING}",
+]
+NOTE = {
+    'Word': '私',
+    'Reading': '',
+    'Meaning': 'I; me',
+    'Sentence': '私は学生です。',
+    'Audio': '',
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    parse = timeit.timeit(lambda: [urltemplate.UrlTemplate(t) for t in TEMPLATES], number=iterations // 10)
+    print("parse:       %8.2f us per source" % (parse / (iterations // 10) / len(TEMPLATES) * 1e6))
+
+    templates = [urltemplate.UrlTemplate(t) for t in TEMPLATES]
+    render = timeit.timeit(lambda: [t.render(NOTE, True) for t in templates], number=iterations)
+    print("render:      %8.2f us per source" % (render / iterations / len(TEMPLATES) * 1e6))
+
+    field_names = tuple(NOTE)
+    field_values = list(NOTE.values())
+    bound = [t.bind(field_names) for t in templates]
+    render_bound = timeit.timeit(lambda: [b.render(field_values, True) for b in bound], number=iterations)
+    print("render bound:%8.2f us per source" % (render_bound / iterations / len(TEMPLATES) * 1e6))
+
+    print(templates[0].render(NOTE, True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Local HTTP stub that behaves like the kinds of audio sources the addon is used with
+
+Routes (every route takes ?term=...&reading=...):
+    /direct         audio/mpeg for terms it "has", 404 otherwise
+    /json           JSON like the local audio server on 127.0.0.1:5050, listing /direct for the audio (after a /missing
+                    candidate for terms of odd length)
+    /placeholder    the same "no audio" clip for every term, like JPod101
+    /missing        always 404
+    /slow           like /direct, but with its own (slow) latency
+    /flaky          like /direct, but now and then the server hangs for a long time before answering
+    /busy           always 429 with a Retry-After header
+    /hiccup         like /direct, but the first request for some terms gets a 429 with a Retry-After header
+    /batch          a JSON object of word -> list of /direct URLs for many words at once, POSTed as
+                    {"terms": [{"word": ..., "reading": ...}, ...]} or as repeated word and reading query parameters
+
+Each route has a latency distribution (log-normal, given as median seconds and sigma), a hit rate, a stall rate and
+a busy rate.
+Run it on its own with: python benchmarks/stub_server.py [port]
+"""
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, quote
+
+PLACEHOLDER_CLIP = b'ID3' + b'\x00' * 1021 + b'no audio' * 128
+
+
+class Route:
+    def __init__(self, median=0.002, sigma=0.5, hit_rate=1.0, stall_rate=0.0, stall=20.0, busy_rate=0.0):
+        self.median = median
+        self.sigma = sigma
+        self.hit_rate = hit_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.busy_rate = busy_rate
+
+    def delay(self):
+        if self.stall_rate and random.random() < self.stall_rate:
+            return self.stall
+        if self.median <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.sigma) * self.median
+
+    def has(self, term):
+        """
+        Deterministic per term, so the same term always hits or misses
+        """
+        return int(hashlib.md5(term.encode('utf-8')).hexdigest()[:4], 16) / 65536.0 < self.hit_rate
+
+    def is_busy(self, term):
+        """
+        Deterministic per term like has(), but independent of it
+        """
+        return int(hashlib.md5(term.encode('utf-8')).hexdigest()[4:8], 16) / 65536.0 < self.busy_rate
+
+
+DEFAULT_ROUTES = {
+    'direct': Route(0.002, 0.5, 0.9),
+    'json': Route(0.003, 0.5, 0.7),
+    'placeholder': Route(0.02, 0.3),
+    'missing': Route(0.002, 0.3),
+    'slow': Route(0.5, 0.5, 0.9),
+    'busy': Route(0.002, 0.3),
+    'flaky': Route(0.005, 0.5, 0.9, stall_rate=0.02),
+    'hiccup': Route(0.002, 0.5, 0.9, busy_rate=0.2),
+    'batch': Route(0.005, 0.5, 0.7),
+}
+
+
+def audio_for(term, reading):
+    """
+    Some deterministic "audio" for a term, between roughly 8 and 40 KB
+    """
+    digest = hashlib.sha256((term + '\x1f' + reading).encode('utf-8')).digest()
+    return b'ID3' + digest * (256 + digest[0] * 4)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # Keep-alive, like real servers
+    disable_nagle_algorithm = True  # Headers and body are written separately, don't let them wait on each other
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body=b'', content_type='audio/mpeg', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def direct_url(self, term, reading):
+        return '%s/direct?term=%s&reading=%s' % (self.server.base_url, quote(term), quote(reading))
+
+    def send_batch(self, route, pairs):
+        time.sleep(route.delay())
+        answer = {term: [self.direct_url(term, reading)] for term, reading in pairs if route.has(term)}
+        self.send_body(200, json.dumps(answer).encode('utf-8'), 'application/json')
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        name = parts.path.strip('/')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if name != 'batch':
+            self.send_body(404, content_type='text/plain')
+            return
+        terms = json.loads(body.decode('utf-8')).get('terms', [])
+        self.send_batch(self.server.routes[name], [(t.get('word', ''), t.get('reading', '')) for t in terms])
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        name = parts.path.strip('/')
+        query = parse_qs(parts.query)
+        term = query.get('term', [''])[0]
+        reading = query.get('reading', [''])[0]
+
+        route = self.server.routes.get(name)
+        if route is None:
+            self.send_body(404, content_type='text/plain')
+            return
+        if name == 'batch':
+            self.send_batch(route, zip(query.get('word', []), query.get('reading', [])))
+            return
+        time.sleep(route.delay())
+
+        if route.is_busy(term) and self.server.first_request(term):
+            self.send_body(429, b'slow down', 'text/plain', {'Retry-After': '1'})
+        elif name in ('direct', 'slow', 'flaky', 'hiccup'):
+            if route.has(term):
+                self.send_body(200, audio_for(term, reading))
+            else:
+                self.send_body(404, b'not found', 'text/plain')
+        elif name == 'json':
+            sources = []
+            if route.has(term):
+                query = 'term=%s&reading=%s' % (quote(term), quote(reading))
+                # Like a local audio server listing several candidates, the first of which is sometimes gone
+                if len(term) % 2:
+                    sources.append({'name': 'gone', 'url': '%s/missing?%s' % (self.server.base_url, query)})
+                sources.append({'name': 'stub', 'url': self.direct_url(term, reading)})
+            body = json.dumps({'type': 'audioSourceList', 'audioSources': sources}).encode('utf-8')
+            self.send_body(200, body, 'application/json')
+        elif name == 'placeholder':
+            self.send_body(200, PLACEHOLDER_CLIP)
+        elif name == 'busy':
+            self.send_body(429, b'slow down', 'text/plain', {'Retry-After': '1'})
+        else:
+            self.send_body(404, b'not found', 'text/plain')
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen_lock = threading.Lock()
+        self.seen_terms = set()
+
+    def first_request(self, term):
+        """
+        Whether this is the first time the term is asked for
+        """
+        with self.seen_lock:
+            if term in self.seen_terms:
+                return False
+            self.seen_terms.add(term)
+            return True
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on a slow response (timeouts, cancelled races) are expected, anything else isn't
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_stub_server(port=0, routes=None):
+    """
+    Starts the stub on 127.0.0.1 in a background thread
+    Returns the server (call shutdown() on it when done) and its base URL
+    """
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    server.routes = dict(DEFAULT_ROUTES)
+    server.routes.update(routes or {})
+    server.base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, server.base_url
+
+
+if __name__ == '__main__':
+    stub_server, stub_url = start_stub_server(int(sys.argv[1]) if len(sys.argv) > 1 else 5050)
+    print("Stub audio server running on", stub_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub_server.shutdown()
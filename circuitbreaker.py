@@ -0,0 +1,132 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles skipping sources that are down or blocking us, instead of waiting on them for
+                    every note.
+                Each source has a circuit breaker that opens after a number of failures in a row (connection errors,
+                    timeouts, 403/429/503 responses). While it is open the source is skipped, and once the cooldown is
+                    over a single probe request is let through (half-open): if the source answers the breaker closes
+                    again, otherwise it stays open for twice as long.
+"""
+import threading
+import time
+
+import requests
+
+DEFAULT_THRESHOLD = 5
+DEFAULT_COOLDOWN = 60.0
+MAX_COOLDOWN = 15 * 60.0
+# Statuses that mean the source is refusing us or unavailable, rather than missing the audio
+BLOCKED_STATUS_CODES = (403, 429, 503)
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of sending a request to a source whose breaker is open
+    """
+    pass
+
+
+def is_breaker_failure(error):
+    """
+    Whether an error from a request says something about the source being down or blocking us
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return getattr(error, 'status_code', None) in BLOCKED_STATUS_CODES
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=DEFAULT_THRESHOLD, cooldown=DEFAULT_COOLDOWN, on_change=None):
+        """
+        threshold is the amount of failures in a row that open the breaker, 0 never opens it
+        cooldown is how many seconds the breaker stays open before a probe is let through
+        on_change(name, state) is called whenever the breaker changes state
+        """
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _set_state(self, state):
+        """
+        Must be called while holding the lock, returns whether on_change has to be called
+        """
+        if state == self.state:
+            return False
+        self.state = state
+        if state == STATE_OPEN:
+            self.opened_at = time.monotonic()
+        return self.on_change is not None
+
+    def allow(self):
+        """
+        Returns whether a request may be sent to the source right now
+        Once the cooldown is over this lets a single probe through, which has to end in record_success,
+            record_failure or record_other
+        """
+        changed = False
+        with self.lock:
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                changed = self._set_state(STATE_HALF_OPEN)
+            if self.probing:
+                allowed = False
+            else:
+                self.probing = allowed = True
+        if changed:
+            self.on_change(self.name, STATE_HALF_OPEN)
+        return allowed
+
+    def record_success(self):
+        """
+        The source answered (with or without audio)
+        """
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+            changed = self._set_state(STATE_CLOSED)
+        if changed:
+            self.on_change(self.name, STATE_CLOSED)
+
+    def record_failure(self):
+        """
+        The source failed in a way that says it is down or blocking us
+        """
+        changed = False
+        with self.lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN:
+                self.probing = False
+                self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+                changed = self._set_state(STATE_OPEN)
+            elif self.state == STATE_CLOSED and self.threshold and self.failures >= self.threshold:
+                changed = self._set_state(STATE_OPEN)
+        if changed:
+            self.on_change(self.name, STATE_OPEN)
+
+    def record_other(self):
+        """
+        The request ended some other way (cancelled, a bad response, ...), which says nothing about the source
+        A probe that ends like this lets the next request probe instead
+        """
+        with self.lock:
+            self.probing = False
+
+    def is_closed(self):
+        return self.state == STATE_CLOSED
@@ -0,0 +1,24 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    Command line entry point for generating audio outside of Anki, see headless.py
+                Usage: python cli.py notes.csv --output out_folder
+                The addon folder is a package whose __init__ imports aqt, so it is registered under a fixed name
+                    without running __init__. This happens at import time so that worker processes, which import
+                    this file again, can find the package too.
+"""
+import importlib
+import os
+import sys
+import types
+
+PACKAGE_NAME = 'generate_batch_audio'
+
+if PACKAGE_NAME not in sys.modules:
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules[PACKAGE_NAME] = package
+
+if __name__ == '__main__':
+    importlib.import_module(PACKAGE_NAME + '.headless').main()
@@ -0,0 +1,120 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+CREDIT TO Yomichan by FooSoft Productions for the idea of hashing the audio files to be able to compare them.
+https://foosoft.net/projects/yomichan/
+
+Author:         Dillon Wall
+Description:    This file handles recognising the "no audio" placeholder clips some sources return instead of a 404.
+                Fingerprints are grouped by file size and the first few bytes, so a download is only compared by its
+                    SHA-256 digest when it could actually be one of the known placeholders.
+                When turned on, clips that a source returns for many different words and readings are learned as
+                    placeholders and saved to disk.
+"""
+import json
+import os
+import threading
+
+PREFIX_LENGTH = 16
+# Learning is off unless the config turns it on, a real clip that gets learned by mistake is lost for every note
+DEFAULT_LEARN_THRESHOLD = 0
+# The JPod101 no-audio audio file
+JPOD101_NO_AUDIO_SHA256 = 'ae6398b5a27bc8c0a771df6c907ade794be15518174773c58c7c7ddd17098906'
+
+
+class AudioFingerprints:
+    def __init__(self, path=None, learn_threshold=DEFAULT_LEARN_THRESHOLD):
+        """
+        path is the JSON file learned fingerprints are loaded from and saved to (None to not learn between runs)
+        learn_threshold is how many different values every parameter of a source's URL has to have been filled in
+            with for the same clip to come back, before it is treated as a placeholder, 0 turns learning off
+        """
+        self.path = path
+        self.learn_threshold = learn_threshold
+        self.lock = threading.Lock()
+        # Fingerprints are kept per source, with None holding the ones that apply to every source
+        self.sized = {}         # source -> {size: {prefix: set of digests}}
+        self.unsized = {}       # source -> set of digests, for fingerprints added without a size
+        self.learned = []
+        self.seen = {}          # (source, digest) -> {parameter: set of values it came back for}
+
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.learned = json.load(f).get('learned', [])
+            except (OSError, ValueError):
+                self.learned = []
+            for entry in self.learned:
+                self.add(entry, entry.get('source'))
+
+    def add(self, fingerprint, source=None):
+        """
+        Adds a placeholder fingerprint, either a SHA-256 hex digest or a dict with sha256 and optionally size
+            and prefix (the hex of its first bytes)
+        """
+        if isinstance(fingerprint, str):
+            fingerprint = {'sha256': fingerprint}
+        digest = fingerprint['sha256'].lower()
+        size = fingerprint.get('size')
+        prefix = fingerprint.get('prefix')
+
+        if size is None or prefix is None:
+            self.unsized.setdefault(source, set()).add(digest)
+        else:
+            self.sized.setdefault(source, {}).setdefault(size, {}).setdefault(prefix.lower(), set()).add(digest)
+
+    def is_placeholder(self, source, size, head, digest):
+        """
+        Checks a download's size, first bytes and digest against the fingerprints for its source
+        """
+        prefix = None
+        for key in (None, source):
+            by_prefix = self.sized.get(key, {}).get(size)
+            if by_prefix:
+                if prefix is None:
+                    prefix = head[:PREFIX_LENGTH].hex()
+                if digest in by_prefix.get(prefix, ()):
+                    return True
+            if digest in self.unsized.get(key, ()):
+                return True
+        return False
+
+    def observe(self, source, values, size, head, digest):
+        """
+        Records that a source returned a clip for a note, values is the {parameter: value} dict its URL was filled
+            in with (see UrlTemplate.parse)
+        Once the same clip has come back for learn_threshold different values of every parameter that isn't empty,
+            it is learned as a placeholder. A source that only looks notes up by their word returns the same real
+            clip for every reading of a word, which doesn't count as different notes
+        Returns True if the clip was just learned
+        """
+        if self.learn_threshold <= 0 or not values:
+            return False
+
+        with self.lock:
+            seen = self.seen.setdefault((source, digest), {})
+            for name, value in values.items():
+                if value:
+                    seen_values = seen.setdefault(name, set())
+                    if len(seen_values) < self.learn_threshold:
+                        seen_values.add(value)
+            if not seen or any(len(seen_values) < self.learn_threshold for seen_values in seen.values()):
+                return False
+            del self.seen[(source, digest)]
+
+            entry = {'source': source, 'sha256': digest, 'size': size, 'prefix': head[:PREFIX_LENGTH].hex()}
+            self.learned.append(entry)
+            self.add(entry, source)
+            self.save()
+        return True
+
+    def save(self):
+        """
+        Saves the learned fingerprints, must be called while holding the lock
+        """
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'learned': self.learned}, f, indent=2)
+        os.replace(temp_path, self.path)
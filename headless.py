@@ -0,0 +1,329 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles generating audio outside of Anki, so very large jobs don't tie up the desktop app.
+                Notes are read from a CSV/TSV file or straight from a collection file, using the sources from the
+                    addon's config. The coalesced download groups are split into chunks that are spread across a pool
+                    of processes, each running its own AudioDownloader with a pool of worker threads. A process keeps
+                    its AudioDownloader for every chunk it runs, so what it learned about the sources carries over.
+                The audio is saved to a media folder next to a results journal (nid -> file name), which the addon
+                    imports into the collection in one step with Edit > Import Bulk Audio Results...
+                Run it with cli.py in the addon folder: python cli.py --help
+"""
+import argparse
+import csv
+import json
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .audiodownloader import AudioDownloader
+from .pipeline import DownloadPipeline, DownloadJob, DEFAULT_WORKERS, note_args
+from .sourcestats import SourceStats
+from .postprocess import create_post_processor
+from .fingerprints import AudioFingerprints, JPOD101_NO_AUDIO_SHA256
+from .journal import JobJournal, load_journal, completed_nids, STATUS_OK, STATUS_MISS, STATUS_ERROR
+from .notescan import load_jobs, chunks
+from .userfiles import user_files_path
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = 'results.jsonl'
+MEDIA_FOLDER = 'media'
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_PROCESSES = min(4, os.cpu_count() or 1)
+COLLECTION_EXTENSIONS = ('.anki2', '.anki21', '.anki21b')
+
+# The AudioDownloader of this process, shared by every chunk it runs (see init_worker)
+worker_downloader = None
+
+
+def load_config(path=None):
+    """
+    Returns the addon's config the way Anki would: the user's edits in meta.json, or else the defaults in config.json
+    """
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    meta_path = os.path.join(ADDON_DIR, 'meta.json')
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta_config = json.load(f).get('config')
+            if meta_config:
+                return meta_config
+        except (OSError, ValueError):
+            pass
+    with open(os.path.join(ADDON_DIR, 'config.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_table(path, id_column='nid', filter_kana_fld=None):
+    """
+    Returns a DownloadJob for every row of a CSV or TSV file with a header row of field names
+    The id_column is used as the nid if the file has it, otherwise rows are numbered from 1
+    """
+    delimiter = '\t' if os.path.splitext(path)[1].lower() in ('.tsv', '.txt') else ','
+    jobs = []
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row_number, row in enumerate(csv.DictReader(f, delimiter=delimiter), start=1):
+            nid = row.get(id_column) or row_number
+            if isinstance(nid, str) and nid.isdigit():
+                nid = int(nid)
+            jobs.append(DownloadJob(nid, note_args(((key, value or '') for key, value in row.items() if key),
+                                                   filter_kana_fld)))
+    return jobs
+
+
+def read_collection(path, query, audio_fld, filter_kana_fld=None):
+    """
+    Returns a DownloadJob for every note matching query in a collection file that has the audio field
+    The collection must not be open in Anki at the same time
+    """
+    from anki.collection import Collection
+
+    col = Collection(path)
+    try:
+        return load_jobs(col, list(col.find_notes(query)), audio_fld, filter_kana_fld)[0]
+    finally:
+        col.close()
+
+
+def worker_settings(config, args, media_dir):
+    """
+    Returns everything a worker process needs to build its AudioDownloader, as a picklable dict
+    Every process throttles its requests on its own, so each one gets its share of the configured rates
+    """
+    processes = max(1, args.processes)
+    audio_sources = {}
+    source_settings = {}
+    for source in sorted(config['sources'], key=lambda source: source['priority']):
+        settings = {key: value for key, value in source.items() if key not in ('priority', 'name', 'url')}
+        if settings.get('rate'):
+            settings['rate'] = settings['rate'] / processes
+            settings['burst'] = max(1, settings.get('burst', 1) // processes)
+        audio_sources[source['name']] = source['url']
+        source_settings[source['name']] = settings
+
+    delay = config.get('delay_sb') or 0.0
+    default_delay = (delay + (0.0 if config.get('danger_cb') else 0.1)) * processes
+
+    return {
+        'audio_sources': audio_sources,
+        'source_settings': source_settings,
+        'default_delay': default_delay,
+        'media_dir': media_dir,
+        'workers': args.workers,
+        'pool_size': config.get('pool_size') or args.workers,
+        'dedupe_media': config.get('dedupe_media', True),
+        'race_sources': config.get('race_sources', 1),
+        'invalid_audio': config.get('invalid_audio', [JPOD101_NO_AUDIO_SHA256]),
+        'fingerprints_path': user_files_path('fingerprints.json'),
+        'duplicate_fld': args.duplicate,
+        'adaptive_order': bool(config.get('adaptive_cb')),
+        'source_stats_path': (user_files_path('source_stats.json') if config.get('adaptive_order_history', True)
+                              else None),
+        'post_process': {key: value for key, value in config.items()
+                         if key.startswith('post_process') or key == 'ffmpeg_path'},
+        'processes': processes,
+        'pack_index_dir': user_files_path('audio_packs', ''),
+    }
+
+
+def print_breaker_change(audio_name, state):
+    print("Source %s is now %s" % (audio_name, state))
+
+
+def create_downloader(settings):
+    """
+    Builds an AudioDownloader that saves to the output media folder instead of a collection
+    The lookup cache is left out, since its hits point at files in collection.media. Placeholders and source
+        statistics are only loaded from user_files, not saved, so the processes don't all write to the same files
+    """
+    fingerprints = AudioFingerprints(settings['fingerprints_path'], learn_threshold=0)
+    for fingerprint in settings['invalid_audio']:
+        fingerprints.add(fingerprint)
+    return AudioDownloader(settings['audio_sources'], None, settings['source_settings'], settings['default_delay'],
+                           pool_size=settings['pool_size'], dedupe_media=settings['dedupe_media'],
+                           race_sources=settings['race_sources'], fingerprints=fingerprints,
+                           media_dir=settings['media_dir'], source_stats=SourceStats(settings['source_stats_path']),
+                           adaptive_order=settings['adaptive_order'], on_breaker_change=print_breaker_change,
+                           post_processor=create_post_processor(settings['post_process'], settings['processes']),
+                           pack_index_dir=settings['pack_index_dir'])
+
+
+def init_worker(settings):
+    """
+    Runs once in every worker process, builds the AudioDownloader its chunks share and closes it when the process
+        exits. Its circuit breakers, timeouts, sessions and media index carry over from one chunk to the next, so a dead
+        source isn't waited on again for every chunk and the output folder is only scanned once
+    """
+    global worker_downloader
+    worker_downloader = create_downloader(settings)
+    # Worker processes leave without running atexit handlers, but they do run multiprocessing's finalizers
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    global worker_downloader
+    if worker_downloader is not None:
+        worker_downloader.close()
+        worker_downloader = None
+
+
+def run_chunk(settings, jobs):
+    """
+    Runs in a worker process set up by init_worker, downloads the audio for a chunk of jobs
+    Returns (nid, audio file name or None, log) for every job, and the bytes saved by post processing
+    """
+    ad = worker_downloader
+    bytes_saved_before = ad.post_processor.summary()['bytes_saved'] if ad.post_processor else 0
+    results = []
+    pipeline = DownloadPipeline(ad, settings['duplicate_fld'], max_workers=settings['workers'])
+    pipeline.run(jobs, lambda job, audio_filename, log: results.append((job.nid, audio_filename, log)))
+    # Waits for the chunk's audio to be post processed, the files of earlier chunks already were
+    results = [(nid, ad.saved_file_name(audio_filename) if audio_filename else None, log)
+               for nid, audio_filename, log in results]
+    bytes_saved = ad.post_processor.summary()['bytes_saved'] - bytes_saved_before if ad.post_processor else 0
+    return results, bytes_saved
+
+
+def plan_chunks(jobs, settings, chunk_size):
+    """
+    Splits the jobs into chunks of download groups, so notes that share a download always end up in the same chunk
+    """
+    planner = AudioDownloader(settings['audio_sources'], None, dedupe_media=False, media_dir=settings['media_dir'])
+    groups = DownloadPipeline(planner, settings['duplicate_fld']).plan(jobs)
+    planner.close()
+    return [[job for group in chunk for job in group] for chunk in chunks(groups, chunk_size)]
+
+
+def record_results(journal, chunk_results, totals):
+    """
+    Journals a chunk's results and counts them in totals, returns the bytes its post processing saved
+    """
+    results, bytes_saved = chunk_results
+    for nid, audio_filename, log in results:
+        totals[journal.record_result(nid, audio_filename, log)] += 1
+    return bytes_saved
+
+
+def parse_args(argv=None, config=None):
+    config = config or {}
+    parser = argparse.ArgumentParser(
+        prog='cli.py',
+        description="Generate audio for notes outside of Anki, then import it with "
+                    "Edit > Import Bulk Audio Results... in the browser.")
+    parser.add_argument('input', help="a CSV/TSV file with a header row of field names, or a collection file "
+                                      "(collection.anki2) that is not open in Anki")
+    parser.add_argument('-o', '--output', required=True, help="folder the media and %s are written to" % RESULTS_FILE)
+    parser.add_argument('--config', help="config file to use instead of the addon's config")
+    parser.add_argument('--audio-field', help="field the audio is for (default: the one last used in Anki)")
+    parser.add_argument('--filter-kana', help="field to reduce to hiragana (default: the one last used in Anki)")
+    parser.add_argument('--query', default='', help="search for the notes of a collection (default: every note)")
+    parser.add_argument('--id-column', default='nid', help="column of a CSV/TSV file with the note ids")
+    parser.add_argument('-p', '--processes', type=int, default=DEFAULT_PROCESSES)
+    parser.add_argument('-w', '--workers', type=int, help="download threads per process")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="download groups handed to a process at a time")
+    parser.add_argument('--no-duplicate', dest='duplicate', action='store_false',
+                        help="don't duplicate the previous URL parameter to empty fields")
+    parser.add_argument('--restart', action='store_true', help="ignore the results of an earlier run in the output")
+    args = parser.parse_args(argv)
+
+    if args.audio_field is None:
+        args.audio_field = config.get('fsel')
+    if args.filter_kana is None:
+        args.filter_kana = config.get('ksel')
+    if args.workers is None:
+        args.workers = config.get('workers_sb') or DEFAULT_WORKERS
+    if not args.audio_field:
+        parser.error("--audio-field is required")
+    return args
+
+
+def main(argv=None):
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('--config')
+    config = load_config(config_parser.parse_known_args(argv)[0].config)
+    args = parse_args(argv, config)
+
+    media_dir = os.path.join(args.output, MEDIA_FOLDER)
+    os.makedirs(media_dir, exist_ok=True)
+    settings = worker_settings(config, args, media_dir)
+
+    if os.path.splitext(args.input)[1].lower() in COLLECTION_EXTENSIONS:
+        jobs = read_collection(args.input, args.query, args.audio_field, args.filter_kana)
+    else:
+        jobs = read_table(args.input, args.id_column, args.filter_kana)
+
+    # Pick up where an earlier run into the same output left off
+    journal = JobJournal(os.path.join(args.output, RESULTS_FILE))
+    run_info, outcomes = load_journal(journal.path)
+    resume = not args.restart and run_info is not None and run_info.get('audio_fld') == args.audio_field
+    if resume:
+        done_nids = completed_nids(outcomes)
+        jobs = [job for job in jobs if job.nid not in done_nids]
+        print("Resuming, %d notes were already done" % len(done_nids))
+    journal.start({'audio_fld': args.audio_field, 'input': os.path.abspath(args.input), 'media': MEDIA_FOLDER,
+                   'total': len(jobs), 'started': time.time()}, resume=resume)
+
+    # Audio packs are indexed once here, instead of by every process at the same time
+    ad = create_downloader(settings)
+    if ad.packs:
+        print("Indexing audio packs...")
+        ad.load_packs()
+    ad.close()
+
+    total = len(jobs)
+    totals = {STATUS_OK: 0, STATUS_MISS: 0, STATUS_ERROR: 0}
+    bytes_saved = 0
+    started = time.time()
+    job_chunks = plan_chunks(jobs, settings, args.chunk_size)
+    print("%d notes in %d chunks, %d processes with %d workers each" % (total, len(job_chunks), args.processes,
+                                                                        args.workers))
+    try:
+        if args.processes <= 1:
+            init_worker(settings)
+            try:
+                for chunk in job_chunks:
+                    bytes_saved += record_results(journal, run_chunk(settings, chunk), totals)
+                    print("%d / %d notes done" % (sum(totals.values()), total))
+            finally:
+                close_worker()
+        else:
+            executor = ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker, initargs=(settings,))
+            try:
+                futures = [executor.submit(run_chunk, settings, chunk) for chunk in job_chunks]
+                for future in as_completed(futures):
+                    bytes_saved += record_results(journal, future.result(), totals)
+                    print("%d / %d notes done" % (sum(totals.values()), total))
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume")
+    finally:
+        journal.close()
+
+    elapsed = time.time() - started
+    print("%d notes with audio, %d without, %d errors in %.1f s (%.1f notes/sec)" % (
+        totals[STATUS_OK], totals[STATUS_MISS], totals[STATUS_ERROR], elapsed,
+        sum(totals.values()) / elapsed if elapsed else 0))
+    if bytes_saved:
+        print("Post processing saved %.1f MB" % (bytes_saved / 1e6))
+    print("Results written to", journal.path)
+
+
+def load_results(path):
+    """
+    Reads the results of a headless run for importing
+    Returns the audio field, the folder the audio is in and a dict of nid -> audio file name
+    """
+    run_info, outcomes = load_journal(path)
+    if run_info is None:
+        raise ValueError("Not a batch audio results file: " + path)
+    media_dir = os.path.join(os.path.dirname(os.path.abspath(path)), run_info.get('media', MEDIA_FOLDER))
+    files = {nid: entry['f'] for nid, entry in outcomes.items() if entry.get('s') == STATUS_OK and entry.get('f')}
+    return run_info['audio_fld'], media_dir, files
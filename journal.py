@@ -0,0 +1,146 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles keeping a journal of a bulk run, so an interrupted run can be resumed.
+                The journal is an append-only file of one compact JSON line per note, which is only fsynced every
+                    so often instead of after every note.
+"""
+import json
+import os
+import time
+
+from .metrics import OUTCOME_HIT, OUTCOME_MISS
+
+DEFAULT_SYNC_EVERY = 250
+DEFAULT_SYNC_INTERVAL = 5.0
+
+STATUS_OK = 'ok'
+STATUS_MISS = 'miss'
+STATUS_ERROR = 'error'
+# Notes with these outcomes don't need to be downloaded again when resuming
+COMPLETED_STATUSES = (STATUS_OK, STATUS_MISS)
+
+
+def status_for(audio_filename, log):
+    """
+    Sorts the result of a note into STATUS_OK, STATUS_MISS or STATUS_ERROR, returns it along with the last error
+    log is the (source name, outcome) list from AudioDownloader.download_single, a note without audio is an error
+        if any source's outcome was something other than a hit or a miss, so resuming asks the sources again
+    """
+    if audio_filename:
+        return STATUS_OK, None
+    errors = [outcome for _, outcome in log if outcome not in (OUTCOME_HIT, OUTCOME_MISS)]
+    if errors:
+        return STATUS_ERROR, errors[-1]
+    return STATUS_MISS, None
+
+
+class JobJournal:
+    def __init__(self, path, sync_every=DEFAULT_SYNC_EVERY, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = 0.0
+
+    def start(self, run_info, resume=False):
+        """
+        Opens the journal for writing
+        A new run starts a new journal with run_info as its first line, a resumed run keeps appending to the old one
+        """
+        if resume and os.path.exists(self.path):
+            self.file = open(self.path, 'a', encoding='utf-8')
+            # Start on a fresh line in case the last one was cut off by a crash
+            if self.file.tell() > 0:
+                self.file.write('\n')
+        else:
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self._write({'run': run_info})
+            self.sync()
+
+    def record(self, nid, status, file_name=None, sources=None, error=None):
+        """
+        Appends the outcome of a note
+        """
+        entry = {'n': nid, 's': status}
+        if file_name:
+            entry['f'] = file_name
+        if sources:
+            entry['t'] = sources
+        if error:
+            entry['e'] = error
+        self._write(entry)
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def record_result(self, nid, audio_filename, log):
+        """
+        Appends the outcome of a note from its download result (see status_for), returns its status
+        """
+        status, error = status_for(audio_filename, log)
+        self.record(nid, status, file_name=audio_filename,
+                    sources=None if audio_filename else [audio_name for audio_name, _ in log if audio_name],
+                    error=error)
+        return status
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def sync(self):
+        """
+        Makes sure everything recorded so far is on disk
+        """
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def delete(self):
+        """
+        Removes the journal once a run has finished and there is nothing left to resume
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_journal(path):
+    """
+    Reads a journal left behind by an earlier run
+    Returns its run_info and a dict of nid -> last recorded entry, or (None, {}) if there is no journal
+    A line cut off by a crash is ignored
+    """
+    run_info = None
+    outcomes = {}
+    if not os.path.exists(path):
+        return run_info, outcomes
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'run' in entry:
+                run_info = entry['run']
+            elif 'n' in entry:
+                outcomes[entry['n']] = entry
+    return run_info, outcomes
+
+
+def completed_nids(outcomes):
+    """
+    Returns the nids a resumed run can skip
+    """
+    return {nid for nid, entry in outcomes.items() if entry.get('s') in COMPLETED_STATUSES}
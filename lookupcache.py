@@ -0,0 +1,112 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles remembering what each source answered for a URL between runs.
+                Hits are stored as the media file name and its SHA-256 digest, misses are stored as negative
+                    entries that expire after a while, and the least recently used entries are evicted once the
+                    cache grows past its size limit.
+"""
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_MISS_TTL = 7 * 24 * 60 * 60  # A week, sources do get new audio from time to time
+COMMIT_EVERY = 100
+
+# Returned by LookupCache.get for a URL that the source is known to have no audio for
+MISS = object()
+
+
+class LookupCache:
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, miss_ttl=DEFAULT_MISS_TTL):
+        self.max_entries = max_entries
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "  source TEXT NOT NULL,"
+            "  url TEXT NOT NULL,"
+            "  filename TEXT,"
+            "  sha256 TEXT,"
+            "  created REAL NOT NULL,"
+            "  accessed REAL NOT NULL,"
+            "  PRIMARY KEY (source, url))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS lookups_accessed ON lookups (accessed)")
+        self.db.commit()
+
+    def get(self, source, url):
+        """
+        Returns (filename, sha256) for a cached hit, MISS for a cached miss, or None if the URL isn't cached
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT filename, sha256, created FROM lookups WHERE source = ? AND url = ?", (source, url)
+            ).fetchone()
+            if row is None:
+                return None
+
+            filename, sha256, created = row
+            if filename is None and now - created > self.miss_ttl:
+                self.db.execute("DELETE FROM lookups WHERE source = ? AND url = ?", (source, url))
+                self._wrote()
+                return None
+
+            self.db.execute("UPDATE lookups SET accessed = ? WHERE source = ? AND url = ?", (now, source, url))
+            self._wrote()
+
+        if filename is None:
+            return MISS
+        return filename, sha256
+
+    def put(self, source, url, filename=None, sha256=None):
+        """
+        Records a hit (filename and sha256) or a miss (no filename) for a source's URL
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO lookups (source, url, filename, sha256, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (source, url, filename, sha256, now, now)
+            )
+            self._wrote()
+
+    def forget(self, source, url):
+        """
+        Removes an entry, used when a cached file no longer exists in the collection
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM lookups WHERE source = ? AND url = ?", (source, url))
+            self._wrote()
+
+    def _wrote(self):
+        """
+        Commits (and evicts) every so often instead of on every single write
+        Must be called while holding the lock
+        """
+        self.writes += 1
+        if self.writes >= COMMIT_EVERY:
+            self._flush()
+
+    def _flush(self):
+        self.writes = 0
+        (count,) = self.db.execute("SELECT COUNT(*) FROM lookups").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM lookups WHERE rowid IN "
+                "(SELECT rowid FROM lookups ORDER BY accessed LIMIT ?)", (count - self.max_entries,)
+            )
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
@@ -12,20 +12,36 @@ Description:    An addon for Anki that downloads and adds audio in a bulk operat
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import os
 import time
 
 from aqt.qt import *
-from aqt.utils import tooltip
+from aqt.utils import tooltip, askUser
 
 from anki.hooks import addHook
 from aqt import mw
-from aqt.operations import QueryOp
+from aqt.operations import QueryOp, CollectionOp
 
 from .audiodownloader import *
+from .pipeline import DownloadPipeline, DEFAULT_WORKERS
+from .lookupcache import LookupCache, DEFAULT_MAX_ENTRIES, DEFAULT_MISS_TTL
+from .userfiles import user_files_path
+from .fingerprints import AudioFingerprints, DEFAULT_LEARN_THRESHOLD, JPOD101_NO_AUDIO_SHA256
+from .journal import JobJournal, load_journal, completed_nids, STATUS_OK
+from .notescan import load_jobs, list_media
+from .metrics import RunMetrics
+from .sourcestats import SourceStats
+from .postprocess import create_post_processor
+from .headless import load_results, RESULTS_FILE
 
 # Config setup
 config = mw.addonManager.getConfig(__name__)
 
+UNDO_NAME = "Generate Batch Audio"
+# Amount of modified notes written to the collection at once
+NOTE_UPDATE_CHUNK = 250
+REPORT_COLUMNS = ["Source", "Requests", "Hits", "Misses", "Placeholders", "Errors", "p50 ms", "p95 ms", "MB"]
+
 
 def deleteItemsOfLayout(layout):
     """
@@ -49,6 +65,8 @@ class SourceHBox(QHBoxLayout):
         self.changePriority = changePriority
         self.removeSource = removeSource
         self.parentDialog = parentDialog
+        # Options from the config that have no UI element (rate, burst, ...), kept so saving doesn't drop them
+        self.settings = {}
 
         self.position_label = QLabel(str(self.priority) + ": ")
 
@@ -59,6 +77,12 @@ class SourceHBox(QHBoxLayout):
         self.cu_textbox = QLineEdit()
         self.cu_textbox.setPlaceholderText("Enter Custom URL")
 
+        self.stats_label = QLabel()
+        self.stats_label.setToolTip("How often this source had the audio, and how long it took on average")
+
+        self.pin_cb = QCheckBox("Pin")
+        self.pin_cb.setToolTip("With adaptive source order, pinned sources are always tried first, in priority order")
+
         self.source_button_box = QDialogButtonBox(Qt.Orientation.Horizontal, self.parentDialog)
         self.source_button_box.setMaximumWidth(60)
         self.moveup_btn = self.source_button_box.addButton("^",
@@ -77,6 +101,8 @@ class SourceHBox(QHBoxLayout):
         self.addWidget(self.position_label)
         self.addWidget(self.name_textbox)
         self.addWidget(self.cu_textbox)
+        self.addWidget(self.stats_label)
+        self.addWidget(self.pin_cb)
         self.addWidget(self.source_button_box)
 
     def changePriorityNumber(self, amount):
@@ -97,10 +123,20 @@ class SourceHBox(QHBoxLayout):
     def getInfo(self):
         return self.name_textbox.text(), self.cu_textbox.text()
 
+    def getSettings(self):
+        settings = dict(self.settings)
+        settings['pinned'] = self.pin_cb.isChecked()
+        return settings
+
+    def setStats(self, text):
+        self.stats_label.setText(text)
+
     def loadFromDict(self, dict):
         self.setPriorityNumber(dict['priority'])
         self.name_textbox.setText(dict['name'])
         self.cu_textbox.setText(dict['url'])
+        self.settings = {key: value for key, value in dict.items() if key not in ('priority', 'name', 'url', 'pinned')}
+        self.pin_cb.setChecked(bool(dict.get('pinned')))
 
     def saveAsDict(self):
         dict = {
@@ -108,6 +144,7 @@ class SourceHBox(QHBoxLayout):
             'name': self.name_textbox.text(),
             'url': self.cu_textbox.text()
         }
+        dict.update(self.getSettings())
         return dict
 
 
@@ -121,6 +158,7 @@ class BulkGenerateDialog(QDialog):
         self.num_sources = 0
         self.sources = []
         self.sources_vbox = QVBoxLayout()
+        self.source_stats = SourceStats(user_files_path('source_stats.json'))
 
         self._setupUi()
 
@@ -147,6 +185,9 @@ class BulkGenerateDialog(QDialog):
         config['ksel'] = self.ksel.currentText()
         config['dup_cb'] = self.dup_cb.isChecked()
         config['danger_cb'] = self.danger_cb.isChecked()
+        config['workers_sb'] = self.workers_sb.value()
+        config['missing_cb'] = self.missing_cb.isChecked()
+        config['adaptive_cb'] = self.adaptive_cb.isChecked()
         mw.addonManager.writeConfig(__name__, config)
 
     def loadConfig(self):
@@ -171,6 +212,13 @@ class BulkGenerateDialog(QDialog):
             self.dup_cb.setChecked(config['dup_cb'])
         if config['danger_cb']:
             self.danger_cb.setChecked(config['danger_cb'])
+        if config.get('workers_sb'):
+            self.workers_sb.setValue(config['workers_sb'])
+        if config.get('missing_cb'):
+            self.missing_cb.setChecked(config['missing_cb'])
+        if config.get('adaptive_cb'):
+            self.adaptive_cb.setChecked(config['adaptive_cb'])
+        self.showSourceStats()
 
     def closeEvent(self, evnt):
         """
@@ -192,7 +240,7 @@ class BulkGenerateDialog(QDialog):
         self.fsel.addItems(fields)
 
         dlabel = QLabel("Delay between requests:")
-        dlabel.setToolTip("This specifies the delay in seconds between each HTTP request to download audio.\n\nIf you are downloading from Forvo or another source that has bot detection, use a VPN or set this to a higher delay.")
+        dlabel.setToolTip("This specifies the delay in seconds between each HTTP request to download audio.\n\nThis applies to each site separately, and only to sources that don't set their own 'rate' in the addon config and aren't on this computer.\n\nIf you are downloading from Forvo or another source that has bot detection, use a VPN or set this to a higher delay.")
         self.delay_sb = QDoubleSpinBox()
         self.delay_sb.setDecimals(1)
         self.delay_sb.setMinimum(0)
@@ -212,9 +260,24 @@ class BulkGenerateDialog(QDialog):
         self.dup_cb.setChecked(True)
 
         dangerlabel = QLabel("Dangerously fast:")
-        dangerlabel.setToolTip("If enabled, will run 0.1s faster per card, but likely give you errors.")
+        dangerlabel.setToolTip("If enabled, removes the extra 0.1s delay between requests to sources without their own 'rate', but likely give you errors.")
         self.danger_cb = QCheckBox()
 
+        wlabel = QLabel("Concurrent downloads:")
+        wlabel.setToolTip("This specifies how many notes will be downloaded at the same time.\n\nSet this to 1 to download one note at a time like before.")
+        self.workers_sb = QSpinBox()
+        self.workers_sb.setMinimum(1)
+        self.workers_sb.setMaximum(64)
+        self.workers_sb.setValue(DEFAULT_WORKERS)
+
+        missinglabel = QLabel("Only fill missing audio:")
+        missinglabel.setToolTip("If enabled, notes whose audio field already plays a file that exists in your collection will be skipped.\n\nNotes with an empty audio field, or one that points at a missing file, will still be downloaded.")
+        self.missing_cb = QCheckBox()
+
+        adaptivelabel = QLabel("Adaptive source order:")
+        adaptivelabel.setToolTip("If enabled, sources are tried in the order that takes the least time and requests per audio found, based on how they did so far, instead of strictly in priority order.\n\nPinned sources are still tried first. A note may get its audio from a lower priority source this way.")
+        self.adaptive_cb = QCheckBox()
+
         f_grid = QGridLayout()
         f_grid.addWidget(flabel, 0, 1)
         f_grid.addWidget(self.fsel, 0, 2)
@@ -230,6 +293,20 @@ class BulkGenerateDialog(QDialog):
 
         f_grid.addWidget(dlabel, 2, 1)
         f_grid.addWidget(self.delay_sb, 2, 2)
+        f_grid.addWidget(wlabel, 2, 4, 1, 3)
+        f_grid.addWidget(self.workers_sb, 2, 7)
+
+        f_grid.addWidget(missinglabel, 3, 1)
+        f_grid.addWidget(self.missing_cb, 3, 2)
+        f_grid.addWidget(adaptivelabel, 3, 4, 1, 3)
+        f_grid.addWidget(self.adaptive_cb, 3, 7)
+
+        # Per-source summary of the last run, hidden until a run finishes
+        self.report_table = QTableWidget(0, len(REPORT_COLUMNS))
+        self.report_table.setHorizontalHeaderLabels(REPORT_COLUMNS)
+        self.report_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.report_table.verticalHeader().setVisible(False)
+        self.report_table.hide()
 
         # setup buttons
         button_box_hbox = QHBoxLayout()
@@ -258,6 +335,7 @@ class BulkGenerateDialog(QDialog):
         self.layout_bottom = QVBoxLayout()
         self.layout_bottom.addLayout(f_grid)
         self.layout_bottom.addSpacing(20)
+        self.layout_bottom.addWidget(self.report_table)
         button_box_hbox.addLayout(button_box_vbox_left)
         button_box_hbox.addLayout(button_box_vbox_right)
         self.layout_bottom.addLayout(button_box_hbox)
@@ -342,6 +420,29 @@ class BulkGenerateDialog(QDialog):
         self.sources.append(source)
         self.sources_vbox.addLayout(source)
 
+    def showSourceStats(self):
+        """
+        Shows how every source did in earlier runs next to it
+        """
+        for source in self.sources:
+            source.setStats(self.source_stats.summary(source.getInfo()[0]))
+
+    def showReport(self, rows):
+        """
+        Fills the summary table with one row per source from RunMetrics.summary_rows
+        """
+        self.report_table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(str(value))
+                if column > 0:
+                    item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self.report_table.setItem(row, column, item)
+        self.report_table.resizeColumnsToContents()
+        self.report_table.show()
+        self.source_stats = SourceStats(user_files_path('source_stats.json'))
+        self.showSourceStats()
+
     def onGenerate(self):
         """
         Actually generate the audio for each card selected
@@ -349,95 +450,281 @@ class BulkGenerateDialog(QDialog):
         """
         filter_kana_fld = self.ksel.currentText()
         duplicate_fld = self.dup_cb.isChecked()
-        sleep_time = self.delay_sb.value() + (0.0 if self.danger_cb.isChecked() else 0.1)
+        default_delay = self.delay_sb.value() + (0.0 if self.danger_cb.isChecked() else 0.1)
         audio_sources = {}
+        source_settings = {}
         for source in self.sources:
             name, url = source.getInfo()
             audio_sources.update({name: url})
+            source_settings.update({name: source.getSettings()})
 
         browser = self.browser
         mw = browser.mw
         nids = self.nids
         audio_fld = self.fsel.currentText()
-        ad = AudioDownloader(audio_sources, mw)
-
-        mw.checkpoint("batch add audio")
-        mw.progress.start()
-        browser.model.beginReset()
+        max_workers = self.workers_sb.value()
+        only_missing = self.missing_cb.isChecked()
+        lookup_cache = None
+        if config.get('lookup_cache', True):
+            lookup_cache = LookupCache(user_files_path('lookup_cache.sqlite'),
+                                       max_entries=config.get('lookup_cache_size', DEFAULT_MAX_ENTRIES),
+                                       miss_ttl=config.get('lookup_cache_miss_ttl', DEFAULT_MISS_TTL))
+        fingerprints = AudioFingerprints(user_files_path('fingerprints.json'),
+                                         learn_threshold=config.get('learn_invalid_audio', DEFAULT_LEARN_THRESHOLD))
+        for fingerprint in config.get('invalid_audio', [JPOD101_NO_AUDIO_SHA256]):
+            fingerprints.add(fingerprint)
+        metrics = RunMetrics()
+        source_stats = SourceStats(user_files_path('source_stats.json'), load=config.get('adaptive_order_history', True))
+        post_processor = create_post_processor(config)
+        if config.get('post_process') and not post_processor:
+            tooltip("ffmpeg was not found, audio will be saved as it is downloaded.", parent=self)
+        ad = AudioDownloader(audio_sources, mw, source_settings, default_delay,
+                             pool_size=config.get('pool_size') or max_workers, lookup_cache=lookup_cache,
+                             dedupe_media=config.get('dedupe_media', True),
+                             race_sources=config.get('race_sources', 1), fingerprints=fingerprints, metrics=metrics,
+                             source_stats=source_stats, adaptive_order=self.adaptive_cb.isChecked(),
+                             post_processor=post_processor, pack_index_dir=user_files_path('audio_packs', ''))
+
+        # Offer to pick up where an interrupted run left off
+        journal = JobJournal(user_files_path('journal.jsonl'))
+        resume = False
+        run_info, outcomes = load_journal(journal.path)
+        if run_info and run_info.get('audio_fld') == audio_fld:
+            done_nids = completed_nids(outcomes).intersection(nids)
+            if done_nids and askUser("A previous run was interrupted after {0} of the selected notes were done.\n\n"
+                                     "Resume it and skip those notes?".format(len(done_nids)), parent=self):
+                nids = [nid for nid in nids if nid not in done_nids]
+                resume = True
+        journal.start({'audio_fld': audio_fld, 'total': len(nids), 'started': time.time()}, resume=resume)
 
         op = QueryOp(
             parent=mw,
-            op=lambda col: _processNotes(browser, nids, audio_fld, sleep_time, filter_kana_fld, ad, duplicate_fld),
-            success=_processNotesOnSuccess
+            op=lambda col: _processNotes(browser, nids, audio_fld, filter_kana_fld, ad, duplicate_fld, max_workers,
+                                         journal, only_missing),
+            success=lambda results: _processNotesOnSuccess(results, self)
         )
         op.with_progress().run_in_background()
 
 
-def _processNotes(browser, nids, audio_fld, sleep_time, filter_kana_fld, ad, duplicate_fld):
+def _processNotes(browser, nids, audio_fld, filter_kana_fld, ad, duplicate_fld, max_workers=DEFAULT_WORKERS,
+                  journal=None, only_missing=False):
     """
     The main function that handles downloading and adding audio to each card
     This function is meant to run in the background as to not hang the main window
+    Downloads are spread across a pool of workers, but notes are only loaded and written from this thread
+    The fields of every selected note are loaded in bulk before the first download starts
+    Every note's outcome is recorded in the journal, which is deleted again if the run isn't interrupted
+    If only_missing is set, notes whose audio field already plays an existing file are skipped
     """
-    total = len(nids)
-    cnt = 0
-    last_progress = 0
-    for nid in nids:
-        # Update progress
-        if time.time() - last_progress >= 0.1:
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=f"{cnt} / {total} cards updated",
-                    value=cnt,
-                    max=total,
-                )
+    mw.taskman.run_on_main(lambda: mw.progress.update(label="Loading notes..."))
+    media_files = list_media(mw.col.media.dir()) if only_missing else None
+    jobs, skipped = load_jobs(mw.col, nids, audio_fld, filter_kana_fld, media_files)
+
+    total = len(jobs)
+    if ad.packs:
+        mw.taskman.run_on_main(lambda: mw.progress.update(label="Indexing audio packs..."))
+        ad.load_packs()
+    mw.taskman.run_on_main(lambda: mw.progress.update(label="Planning downloads..."))
+
+    # Every chunk of updated notes gets merged into this entry, so the whole run can be undone in one step
+    undo_entry = mw.col.add_custom_undo_entry(UNDO_NAME)
+    modified_notes = []
+    modified_files = []
+    # How many of modified_notes were held back by the last write, because their audio was still being processed
+    held_back = 0
+
+    def write_notes(wait=False):
+        """
+        Writes the notes whose audio is done being post processed, which decides the name each file ends up with
+        The others are held back until a later chunk, or until wait is set once the post processor is done
+        """
+        nonlocal held_back
+        ready_notes = []
+        ready_files = []
+        waiting = []
+        for note, audio_filename in zip(modified_notes, modified_files):
+            saved_file_name = ad.saved_file_name(audio_filename, wait)
+            if saved_file_name is None:
+                waiting.append((note, audio_filename))
+                continue
+            note[audio_fld] = '[sound:' + saved_file_name + ']'
+            ready_notes.append(note)
+            ready_files.append(saved_file_name)
+        modified_notes[:] = [note for note, _ in waiting]
+        modified_files[:] = [audio_filename for _, audio_filename in waiting]
+        held_back = len(waiting)
+
+        if ready_notes:
+            mw.col.update_notes(ready_notes)
+            mw.col.merge_undo_entries(undo_entry)
+            # Only journal notes once they are actually written, so a resumed run never skips an unsaved note
+            if journal:
+                for note, audio_filename in zip(ready_notes, ready_files):
+                    journal.record(note.id, STATUS_OK, file_name=audio_filename)
+                journal.sync()
+
+    def on_result(job, audio_filename, log):
+        if audio_filename:
+            modified_notes.append(mw.col.getNote(job.nid))
+            modified_files.append(audio_filename)
+            if len(modified_notes) - held_back >= NOTE_UPDATE_CHUNK:
+                write_notes()
+        elif journal:
+            journal.record_result(job.nid, None, log)
+
+    def on_progress(cnt):
+        label = f"{cnt} / {total} cards updated"
+        # Sources whose circuit breaker is open are skipped until they answer again
+        skipped_sources = ad.open_breakers()
+        if skipped_sources:
+            label += "\nSkipping (not responding): " + ", ".join(skipped_sources)
+        mw.taskman.run_on_main(
+            lambda: mw.progress.update(
+                label=label,
+                value=cnt,
+                max=total,
             )
-            last_progress = time.time()
-
-        note = mw.col.getNote(nid)
-
-        if audio_fld in note:
-            # IMPORTANT: BEFORE DOWNLOADING, SLEEP FOR SET TIME IF APPLICABLE
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-
-            note_dict = {}
-            for key, value in note.items():
-                if key == filter_kana_fld:  # If '(None)' then it shouldn't find it anyway (unless someone has that as their field name for some reason)
-                    value = filter_kana(value)
-                note_dict.update({key: value})
-
-            audio_filename = ad.download_single(note_dict, duplicate_fld)
-            if audio_filename:
-                note[audio_fld] = '[sound:' + audio_filename + ']'
-                note.flush()
-            cnt += 1
-
-        if mw.progress.want_cancel():
-            break
-
-    return browser, cnt
-
+        )
 
-def _processNotesOnSuccess(browser_cnt_tuple):
+    pipeline = DownloadPipeline(ad, duplicate_fld, max_workers=max_workers)
+    finished = False
+    cancelled = False
+    try:
+        cnt, cancelled = pipeline.run(jobs, on_result, want_cancel=mw.progress.want_cancel, on_progress=on_progress)
+        finished = not cancelled
+    finally:
+        if ad.post_processor:
+            mw.taskman.run_on_main(lambda: mw.progress.update(label="Processing audio..."))
+        ad.close()
+        ad.source_stats.save()
+        write_notes(wait=True)
+        if journal:
+            if finished:
+                journal.delete()
+            else:
+                journal.close()
+
+    results = {
+        'browser': browser,
+        'cnt': cnt,
+        'skipped': skipped,
+        'coalesced_notes': pipeline.coalesced_notes,
+        'requests_saved': pipeline.requests_saved,
+        'undo_entry': undo_entry,
+        'summary_rows': ad.metrics.summary_rows(),
+        'post_processing': ad.post_processor.summary() if ad.post_processor else None,
+    }
+
+    report_path = user_files_path('reports', time.strftime('run-%Y%m%d-%H%M%S.json'))
+    ad.metrics.write_report(report_path, extra={
+        'notes': total,
+        'finished': cnt,
+        'cancelled': cancelled,
+        'skipped': skipped,
+        'coalesced_notes': pipeline.coalesced_notes,
+        'requests_saved': pipeline.requests_saved,
+        'retries': pipeline.retries,
+        'timeouts': ad.current_timeouts(),
+        'post_processing': results['post_processing'],
+    })
+    results['report_path'] = report_path
+
+    return results
+
+
+def _processNotesOnSuccess(results, dialog=None):
     """
     On success function for the _processNotes function
-    Resets necessary items and displays a tooltip of the amount of notes updated
+    Resets necessary items, displays a tooltip of the amount of notes updated and fills in the dialog's summary table
     """
-    browser = browser_cnt_tuple[0]
-    cnt = browser_cnt_tuple[1]
-    browser.model.endReset()
-    mw.requireReset()
-    mw.progress.finish()
-    mw.reset()
-    tooltip("<b>Updated</b> {0} notes.".format(cnt), parent=browser)
-
-
-def filter_kana(string):
+    browser = results['browser']
+    if dialog:
+        dialog.showReport(results['summary_rows'])
+
+    # Running the final merge as a CollectionOp lets Anki refresh the browser and the undo menu by itself
+    CollectionOp(parent=browser, op=lambda col: col.merge_undo_entries(results['undo_entry'])).run_in_background()
+    message = "<b>Updated</b> {0} notes.".format(results['cnt'])
+    if results['skipped']:
+        message += "<br>{0} notes already had audio and were skipped.".format(results['skipped'])
+    if results.get('missing'):
+        message += "<br>{0} notes were not found or don't have the audio field.".format(results['missing'])
+    if results['coalesced_notes']:
+        message += "<br>{0} notes shared a download with another note, saving {1} requests.".format(
+            results['coalesced_notes'], results['requests_saved'])
+    if results.get('post_processing'):
+        message += "<br>Processed {0} audio files, saving {1:.1f} MB.".format(
+            results['post_processing']['files'], results['post_processing']['bytes_saved'] / 1e6)
+    tooltip(message, parent=browser)
+
+
+def _importResults(browser, path):
     """
-    Use a Regex filter to only return the hiragana from a string
+    Imports the results of a headless run (see headless.py) as a single undoable operation
+    Every audio file is added to collection.media once, then the notes are written in chunks like _processNotes
     """
-    hiragana_full = r'[ぁ-ゟ]'
-    return ''.join(re.findall(hiragana_full, string))
+    audio_fld, media_dir, files = load_results(path)
+    total = len(files)
+    undo_entry = mw.col.add_custom_undo_entry(UNDO_NAME)
+    added_files = {}
+    modified_notes = []
+    cnt = 0
+    missing = 0
+
+    for nid, audio_filename in files.items():
+        try:
+            note = mw.col.getNote(nid)
+        except Exception:
+            missing += 1
+            continue
+        if audio_fld not in note:
+            missing += 1
+            continue
+
+        if audio_filename not in added_files:
+            # add_file returns the name actually used, which differs if another file already had this name
+            added_files[audio_filename] = mw.col.media.add_file(os.path.join(media_dir, audio_filename))
+        note[audio_fld] = '[sound:' + added_files[audio_filename] + ']'
+        modified_notes.append(note)
+
+        if len(modified_notes) >= NOTE_UPDATE_CHUNK:
+            mw.col.update_notes(modified_notes)
+            mw.col.merge_undo_entries(undo_entry)
+            cnt += len(modified_notes)
+            modified_notes.clear()
+            mw.taskman.run_on_main(
+                lambda cnt=cnt: mw.progress.update(label=f"{cnt} / {total} cards updated", value=cnt, max=total))
+
+    if modified_notes:
+        mw.col.update_notes(modified_notes)
+        mw.col.merge_undo_entries(undo_entry)
+        cnt += len(modified_notes)
+
+    return {
+        'browser': browser,
+        'cnt': cnt,
+        'skipped': 0,
+        'missing': missing,
+        'coalesced_notes': 0,
+        'requests_saved': 0,
+        'undo_entry': undo_entry,
+        'summary_rows': [],
+    }
+
+
+def onImportResults(browser):
+    """
+    Asks for the results file of a headless run and imports it
+    """
+    path, _ = QFileDialog.getOpenFileName(browser, "Import Bulk Audio Results", "",
+                                          "Bulk audio results ({0})".format(RESULTS_FILE))
+    if not path:
+        return
+    op = QueryOp(
+        parent=mw,
+        op=lambda col: _importResults(browser, path),
+        success=lambda results: _processNotesOnSuccess(results)
+    )
+    op.with_progress().run_in_background()
 
 
 def onBulkGenerate(browser):
@@ -463,6 +750,8 @@ def setupMenu(browser):
     a = menu.addAction('Generate Bulk Audio...')
     a.setShortcut(QKeySequence("Ctrl+Alt+B"))
     a.triggered.connect(lambda _, b=browser: onBulkGenerate(b))
+    a = menu.addAction('Import Bulk Audio Results...')
+    a.triggered.connect(lambda _, b=browser: onImportResults(b))
 
 
 addHook("browser.setupMenus", setupMenu)
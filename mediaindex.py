@@ -0,0 +1,90 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles finding audio that is already in the user's collection.media by its content.
+                Files are grouped by size when the index is built, and only files with the same size as a new
+                    download ever get hashed, so the index stays cheap even for very large media folders.
+"""
+import hashlib
+import os
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Downloads in progress are streamed to files starting with this, which are never used as media
+TEMP_FILE_PREFIX = '.batch_audio_'
+
+
+def hashFile(path):
+    """
+    Returns the SHA-256 hex digest of a file, read in chunks
+    """
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+class MediaHashIndex:
+    def __init__(self, media_dir):
+        self.media_dir = media_dir
+        self.lock = threading.Lock()
+        self.by_size = None         # size -> set of file names not hashed yet
+        self.sizes = {}             # file name -> size, for files not hashed yet
+        self.by_digest = {}         # digest -> file name
+        self.digests = {}           # file name -> digest
+
+    def _build(self):
+        """
+        Lists collection.media once, grouping files by size
+        Must be called while holding the lock
+        """
+        self.by_size = {}
+        with os.scandir(self.media_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith(TEMP_FILE_PREFIX):
+                    size = entry.stat().st_size
+                    self.by_size.setdefault(size, set()).add(entry.name)
+                    self.sizes[entry.name] = size
+
+    def find(self, digest, size):
+        """
+        Returns the name of a file in collection.media with the given digest, or None if there isn't one
+        """
+        with self.lock:
+            if self.by_size is None:
+                self._build()
+
+            # Hash any files of the same size that haven't been hashed yet
+            for name in self.by_size.pop(size, ()):
+                self.sizes.pop(name, None)
+                try:
+                    file_digest = hashFile(os.path.join(self.media_dir, name))
+                except OSError:
+                    continue
+                self.digests[name] = file_digest
+                self.by_digest.setdefault(file_digest, name)
+
+            name = self.by_digest.get(digest)
+            if name and not os.path.exists(os.path.join(self.media_dir, name)):
+                self._remove(name)
+                return None
+            return name
+
+    def add(self, name, digest):
+        """
+        Records a file that was just saved to collection.media
+        """
+        with self.lock:
+            self._remove(name)
+            old_size = self.sizes.pop(name, None)
+            if old_size is not None:
+                self.by_size[old_size].discard(name)
+            self.digests[name] = digest
+            self.by_digest.setdefault(digest, name)
+
+    def _remove(self, name):
+        old_digest = self.digests.pop(name, None)
+        if old_digest and self.by_digest.get(old_digest) == name:
+            del self.by_digest[old_digest]
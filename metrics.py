@@ -0,0 +1,171 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles keeping track of how every source performs during a run.
+                For each source it counts requests, hits, misses, placeholders, errors (by exception name) and retries,
+                    keeps a latency histogram and the amount of bytes downloaded, and can write it all to a JSON report.
+"""
+import bisect
+import json
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets, anything slower goes in the last bucket
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
+
+OUTCOME_HIT = 'hit'
+OUTCOME_MISS = 'miss'
+OUTCOME_PLACEHOLDER = 'placeholder'
+OUTCOME_CACHED_HIT = 'cached_hit'
+OUTCOME_CACHED_MISS = 'cached_miss'
+OUTCOMES = (OUTCOME_HIT, OUTCOME_MISS, OUTCOME_PLACEHOLDER, OUTCOME_CACHED_HIT, OUTCOME_CACHED_MISS)
+
+
+def format_ms(seconds):
+    """
+    Formats a latency percentile for the summary table
+    """
+    if seconds is None:
+        return ''
+    if seconds == float('inf'):
+        return '>%g' % (LATENCY_BUCKETS[-1] * 1000)
+    return '%g' % (seconds * 1000)
+
+
+class SourceMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.outcomes = {outcome: 0 for outcome in OUTCOMES}
+        self.errors = {}
+        self.retries = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.bytes = 0
+
+    def error_count(self):
+        return sum(self.errors.values())
+
+    def attempts(self):
+        """
+        Amount of lookups that went to the network (cached answers don't count)
+        """
+        return self.outcomes[OUTCOME_HIT] + self.outcomes[OUTCOME_MISS] + self.outcomes[OUTCOME_PLACEHOLDER] + \
+            self.error_count()
+
+    def latency_percentile(self, q):
+        """
+        Returns an estimate of the q-th (0-100) latency percentile in seconds, from the histogram bucket it falls in
+        """
+        if not self.latency_count:
+            return None
+        target = self.latency_count * q / 100.0
+        seen = 0
+        for i, count in enumerate(self.latency_buckets):
+            seen += count
+            if seen >= target and count:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'outcomes': dict(self.outcomes),
+            'errors': dict(self.errors),
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'latency': {
+                'count': self.latency_count,
+                'mean': self.latency_total / self.latency_count if self.latency_count else None,
+                'buckets': {('<=%g' % bound): count for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)},
+                'slower': self.latency_buckets[-1],
+            },
+        }
+
+
+class RunMetrics:
+    """
+    Thread-safe collection of SourceMetrics, one per source name
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.started = time.time()
+
+    def _source(self, source):
+        metrics = self.sources.get(source)
+        if metrics is None:
+            metrics = self.sources[source] = SourceMetrics()
+        return metrics
+
+    def record_request(self, source):
+        with self.lock:
+            self._source(source).requests += 1
+
+    def record_bytes(self, source, amount):
+        with self.lock:
+            self._source(source).bytes += amount
+
+    def record_retry(self, source):
+        """
+        Records that a note will ask this source again later, after it failed for a moment
+        """
+        with self.lock:
+            self._source(source).retries += 1
+
+    def record_outcome(self, source, outcome, latency=None):
+        """
+        Records the outcome of one lookup, any outcome not in OUTCOMES is counted as an error of that name
+        """
+        with self.lock:
+            metrics = self._source(source)
+            if outcome in metrics.outcomes:
+                metrics.outcomes[outcome] += 1
+            else:
+                metrics.errors[outcome] = metrics.errors.get(outcome, 0) + 1
+            if latency is not None:
+                metrics.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+                metrics.latency_count += 1
+                metrics.latency_total += latency
+
+    def summary_rows(self):
+        """
+        Returns one row per source for the summary table:
+            (source, requests, hits, misses, placeholders, errors, p50 ms, p95 ms, MB)
+        """
+        rows = []
+        with self.lock:
+            for source, metrics in self.sources.items():
+                p50 = metrics.latency_percentile(50)
+                p95 = metrics.latency_percentile(95)
+                rows.append((
+                    source,
+                    metrics.requests,
+                    metrics.outcomes[OUTCOME_HIT] + metrics.outcomes[OUTCOME_CACHED_HIT],
+                    metrics.outcomes[OUTCOME_MISS] + metrics.outcomes[OUTCOME_CACHED_MISS],
+                    metrics.outcomes[OUTCOME_PLACEHOLDER],
+                    metrics.error_count(),
+                    format_ms(p50),
+                    format_ms(p95),
+                    '%.2f' % (metrics.bytes / 1024.0 / 1024.0),
+                ))
+        return rows
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'duration': time.time() - self.started,
+                'sources': {source: metrics.to_dict() for source, metrics in self.sources.items()},
+            }
+
+    def write_report(self, path, extra=None):
+        """
+        Writes the metrics (plus any extra run information) to a JSON file
+        """
+        report = self.to_dict()
+        if extra:
+            report.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,92 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles scanning the selected notes before a run, to find the ones that actually need audio.
+                The audio field of every selected note is read straight from the notes table in chunks, and its
+                    [sound:...] tags are checked against a cached listing of collection.media.
+                It also loads the fields of every selected note the same way, turning them into the DownloadJobs of
+                    a run up front, so downloads never wait on the collection.
+"""
+import os
+import re
+import threading
+
+from .pipeline import DownloadJob, note_args
+
+SOUND_TAG_RE = re.compile(r'\[sound:(.+?)\]')
+NID_CHUNK = 500
+
+_media_listing_lock = threading.Lock()
+_media_listing = (None, None, frozenset())     # (media dir, mtime of the media dir, file names)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def ids_sql(ids):
+    """
+    Returns an SQL list like (1,2,3) for a list of ids
+    """
+    return '(' + ','.join(str(int(i)) for i in ids) + ')'
+
+
+def list_media(media_dir):
+    """
+    Returns the names of every file in collection.media
+    The listing is reused for as long as the folder's modification time doesn't change
+    """
+    global _media_listing
+    mtime = os.stat(media_dir).st_mtime_ns
+    with _media_listing_lock:
+        cached_dir, cached_mtime, names = _media_listing
+        if cached_dir != media_dir or cached_mtime != mtime:
+            with os.scandir(media_dir) as entries:
+                names = frozenset(entry.name for entry in entries if entry.is_file())
+            _media_listing = (media_dir, mtime, names)
+        return names
+
+
+def field_names(col, mid, cache):
+    """
+    Returns the field names of a note type, as a tuple so every note of the type shares it
+    """
+    names = cache.get(mid)
+    if names is None:
+        names = cache[mid] = tuple(field['name'] for field in col.models.get(mid)['flds'])
+    return names
+
+
+def has_working_audio(value, media_files):
+    """
+    A field has working audio if it has at least one [sound:...] tag and every file it references exists
+    """
+    file_names = SOUND_TAG_RE.findall(value)
+    return bool(file_names) and all(file_name in media_files for file_name in file_names)
+
+
+def load_jobs(col, nids, audio_fld, filter_kana_fld=None, media_files=None):
+    """
+    Loads the fields of every note in nids in chunked queries and returns their DownloadJobs (in nid order), along
+        with how many notes were skipped because they already have working audio
+    Notes that don't have the audio field are left out, since they can't be updated anyway
+    If media_files (see list_media) is given, notes whose audio field is empty or points at missing files are the
+        only ones kept
+    """
+    names_by_mid = {}
+    jobs_by_nid = {}
+    skipped = 0
+    for chunk in chunks(list(nids), NID_CHUNK):
+        for nid, mid, flds in col.db.all("select id, mid, flds from notes where id in " + ids_sql(chunk)):
+            names = field_names(col, mid, names_by_mid)
+            if audio_fld not in names:
+                continue
+            values = flds.split('\x1f')
+            index = names.index(audio_fld)
+            if media_files is not None and has_working_audio(values[index] if index < len(values) else '', media_files):
+                skipped += 1
+                continue
+            jobs_by_nid[nid] = DownloadJob(nid, note_args(zip(names, values), filter_kana_fld))
+    return [jobs_by_nid[nid] for nid in nids if nid in jobs_by_nid], skipped
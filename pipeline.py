@@ -0,0 +1,195 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles running an AudioDownloader over many notes at once.
+                Notes are first planned into groups that resolve to the exact same URL for every source, so each
+                    group is only downloaded once. Downloads are handed to a bounded pool of worker threads, while
+                    every result is handed back to the thread that called run() so that notes are only ever written
+                    from one place.
+                A download that hit a source that failed for a moment is put back in the queue to be tried again
+                    once its delay is over, instead of keeping a worker waiting on it.
+"""
+import heapq
+import itertools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .retry import RetryLater, RetryState
+
+DEFAULT_WORKERS = 8
+POLL_INTERVAL = 0.1
+# Everything that isn't hiragana, compiled once instead of for every value
+NOT_HIRAGANA_RE = re.compile(r'[^ぁ-ゟ]+')
+
+
+def filter_kana(string):
+    """
+    Use a Regex filter to only return the hiragana from a string
+    """
+    return NOT_HIRAGANA_RE.sub('', string)
+
+
+def note_args(items, filter_kana_fld=None):
+    """
+    Builds the args_dict of a DownloadJob from a note's (field name, value) pairs
+    The filter_kana_fld field, if the note has it, is reduced to just its hiragana
+    """
+    args_dict = dict(items)
+    # If '(None)' then it shouldn't find it anyway (unless someone has that as their field name for some reason)
+    if filter_kana_fld in args_dict:
+        args_dict[filter_kana_fld] = filter_kana(args_dict[filter_kana_fld])
+    return args_dict
+
+
+class DownloadJob:
+    """
+    A single unit of work for the pipeline: the note it belongs to and the field values used to build the URLs
+    """
+    __slots__ = ('nid', 'args_dict')
+
+    def __init__(self, nid, args_dict):
+        self.nid = nid
+        self.args_dict = args_dict
+
+
+class DownloadPipeline:
+    def __init__(self, ad, duplicate_fld, max_workers=DEFAULT_WORKERS, max_pending=None):
+        self.ad = ad
+        self.duplicate_fld = duplicate_fld
+        self.max_workers = max(1, int(max_workers))
+        # Bound the amount of downloads that are queued or in flight, so that a cancel doesn't have to wait on a
+        #   long backlog and the workers are never handed more than they can keep up with
+        self.max_pending = max_pending if max_pending else self.max_workers * 2
+
+        # Filled in by run()
+        self.coalesced_notes = 0
+        self.requests_saved = 0
+        self.retries = 0
+
+    def plan(self, jobs):
+        """
+        Groups jobs whose notes resolve to the same URL for every source
+        Notes in a group would make the exact same requests, so only the first one is downloaded
+        Returns the groups (lists of jobs) in the order their first note appeared
+        """
+        groups = {}
+        for job in jobs:
+            key = self.ad.resolve_urls(job.args_dict, self.duplicate_fld)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [job]
+            else:
+                group.append(job)
+        return list(groups.values())
+
+    def _download_group(self, group, state, cancel_event):
+        """
+        Runs on a worker thread, returns the file name or raises RetryLater (or DownloadCancelled)
+        The log of sources tried and the requests it took are added to the group's RetryState
+        """
+        before = self.ad.thread_request_count()
+        try:
+            return self.ad.download_single(group[0].args_dict, self.duplicate_fld, state.log, state, cancel_event)
+        finally:
+            state.requests += self.ad.thread_request_count() - before
+
+    def run(self, jobs, on_result, want_cancel=None, on_progress=None):
+        """
+        Downloads audio for every job in jobs
+        on_result(job, audio_filename, log) is called from this thread for every finished job, with log being the
+            (source name, outcome) list filled in by AudioDownloader.download_single
+        Returns the amount of finished jobs and whether the run was cancelled
+        On a cancel, the downloads in flight are aborted and waited on before returning, the ones that still got their
+            audio saved are handed to on_result like any other
+        """
+        groups = self.plan(jobs)
+        self.ad.prepare_batches([group[0].args_dict for group in groups], self.duplicate_fld)
+        self.coalesced_notes = sum(len(group) - 1 for group in groups)
+        self.requests_saved = 0
+        self.retries = 0
+
+        group_iter = iter(groups)
+        exhausted = False
+        cancelled = False
+        finished = 0
+        pending = {}
+        # (time it may run again, tie breaker, group, RetryState) of the groups waiting to be retried
+        retrying = []
+        retry_order = itertools.count()
+        last_progress = 0.0
+
+        cancel_event = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="batch_audio")
+        try:
+            while True:
+                # Top up the queue with the retries that are due, then new groups
+                # Requests are throttled per host by the AudioDownloader itself
+                while len(pending) < self.max_pending:
+                    if retrying and retrying[0][0] <= time.monotonic():
+                        _, _, group, state = heapq.heappop(retrying)
+                    elif not exhausted:
+                        try:
+                            group = next(group_iter)
+                        except StopIteration:
+                            exhausted = True
+                            continue
+                        state = RetryState()
+                    else:
+                        break
+                    future = executor.submit(self._download_group, group, state, cancel_event)
+                    pending[future] = (group, state)
+
+                if exhausted and not pending and not retrying:
+                    break
+
+                if pending:
+                    done, _ = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                else:
+                    # Only retries are left, and none of them are due yet
+                    done = ()
+                    time.sleep(min(POLL_INTERVAL, max(0.0, retrying[0][0] - time.monotonic())))
+
+                for future in done:
+                    group, state = pending.pop(future)
+                    try:
+                        audio_filename = future.result()
+                    except RetryLater as e:
+                        heapq.heappush(retrying, (time.monotonic() + e.delay, next(retry_order), group, state))
+                        self.retries += 1
+                        continue
+                    except Exception as e:
+                        audio_filename = None
+                        state.log.append((None, type(e).__name__))
+                    finished += self._finish_group(group, state, audio_filename, on_result)
+
+                if on_progress and time.time() - last_progress >= POLL_INTERVAL:
+                    on_progress(finished)
+                    last_progress = time.time()
+
+                if want_cancel and want_cancel():
+                    cancelled = True
+                    break
+        finally:
+            # Anything still queued or waiting to be retried is dropped, downloads already in flight are aborted and
+            #   waited on, so none of them still writes to collection.media (or the lookup cache) once run() returns
+            cancel_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        # Downloads that were past the point of being aborted already saved their audio, their notes still get it
+        for future, (group, state) in pending.items():
+            if not future.cancelled() and future.exception() is None:
+                finished += self._finish_group(group, state, future.result(), on_result)
+
+        return finished, cancelled
+
+    def _finish_group(self, group, state, audio_filename, on_result):
+        """
+        Hands a finished download to on_result for every note of its group, returns the amount of notes
+        """
+        self.requests_saved += state.requests * (len(group) - 1)
+        for job in group:
+            on_result(job, audio_filename, state.log)
+        return len(group)
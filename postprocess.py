@@ -0,0 +1,175 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles shrinking the audio that was saved to collection.media.
+                When ffmpeg is installed, every saved clip is transcoded to a compact codec and bitrate, with its
+                    leading and trailing silence trimmed and its loudness normalised.
+                Each clip is its own ffmpeg process, started from a pool of threads that is separate from the download
+                    workers, so downloading carries on while earlier clips are being processed.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .mediaindex import TEMP_FILE_PREFIX
+
+# codec setting -> (ffmpeg encoder, file extension, sample rate)
+CODECS = {
+    'mp3': ('libmp3lame', '.mp3', 44100),
+    'opus': ('libopus', '.ogg', 48000),
+    'vorbis': ('libvorbis', '.ogg', 44100),
+    'aac': ('aac', '.m4a', 44100),
+}
+DEFAULT_CODEC = 'mp3'
+DEFAULT_BITRATE = '64k'
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+FFMPEG_TIMEOUT = 60
+SILENCE_THRESHOLD = '-50dB'
+# Trims the leading silence, then the trailing silence by doing the same on the reversed clip
+TRIM_FILTER = ('silenceremove=start_periods=1:start_threshold={0},areverse,'
+               'silenceremove=start_periods=1:start_threshold={0},areverse').format(SILENCE_THRESHOLD)
+NORMALIZE_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+
+
+def find_ffmpeg(path=None):
+    """
+    Returns the path of the ffmpeg executable, either the given one or the one on the PATH, or None if there is none
+    """
+    if path:
+        return path if os.path.isfile(path) else shutil.which(path)
+    return shutil.which('ffmpeg')
+
+
+class PostProcessor:
+    def __init__(self, ffmpeg, codec=DEFAULT_CODEC, bitrate=DEFAULT_BITRATE, trim_silence=True, normalize=True,
+                 workers=DEFAULT_WORKERS):
+        """
+        ffmpeg is the path of the ffmpeg executable (see find_ffmpeg)
+        codec is one of CODECS, which also decides the extension saved files get
+        """
+        self.ffmpeg = ffmpeg
+        self.encoder, self.extension, self.sample_rate = CODECS[codec]
+        self.bitrate = bitrate
+        self.filters = []
+        if trim_silence:
+            self.filters.append(TRIM_FILTER)
+        if normalize:
+            self.filters.append(NORMALIZE_FILTER)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="batch_audio_ffmpeg")
+
+        self.lock = threading.Lock()
+        self.processing = {}    # file name -> future of the name it ends up with
+        self.files = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def command(self, input_path, output_path):
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', input_path,
+                   '-vn', '-map_metadata', '-1', '-ac', '1', '-ar', str(self.sample_rate)]
+        if self.filters:
+            command += ['-af', ','.join(self.filters)]
+        command += ['-c:a', self.encoder, '-b:a', self.bitrate, output_path]
+        return command
+
+    def submit(self, path, fallback_path=None):
+        """
+        Processes a file that was just saved to collection.media in the background, replacing it once ffmpeg is done
+        The file keeps its name (which should end in self.extension). If ffmpeg fails, or its output isn't any
+            smaller, it is left as downloaded, and moved to fallback_path if given (the name it would have had with the
+            extension it was downloaded with)
+        """
+        future = self.executor.submit(self._process, path, fallback_path)
+        with self.lock:
+            self.processing[os.path.basename(path)] = future
+
+    def final_name(self, file_name, wait=True):
+        """
+        Waits for a file handed to submit to be processed, returns the name it ended up with in collection.media
+        Without wait, None is returned instead if the file is still being processed
+        Files that were never handed to submit keep their name
+        """
+        with self.lock:
+            future = self.processing.get(file_name)
+        if future is None:
+            return file_name
+        if not wait and not future.done():
+            return None
+        return future.result()
+
+    def _process(self, path, fallback_path=None):
+        fd, processed_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, suffix=self.extension,
+                                              dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            size_in = os.path.getsize(path)
+            result = subprocess.run(self.command(path, processed_path), stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=FFMPEG_TIMEOUT,
+                                    creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+            size_out = os.path.getsize(processed_path) if result.returncode == 0 else 0
+            converted = 0 < size_out < size_in
+            if converted:
+                os.replace(processed_path, path)
+            elif size_out:
+                # An already small clip, re-encoding it would only make it bigger
+                size_out = size_in
+        except (OSError, subprocess.SubprocessError):
+            size_in = size_out = 0
+            converted = False
+        finally:
+            if os.path.exists(processed_path):
+                os.remove(processed_path)
+
+        if not converted and fallback_path and fallback_path != path:
+            try:
+                os.replace(path, fallback_path)
+                path = fallback_path
+            except OSError:
+                pass
+
+        with self.lock:
+            self.files += 1
+            if size_out:
+                self.bytes_in += size_in
+                self.bytes_out += size_out
+            else:
+                self.failed += 1
+        return os.path.basename(path)
+
+    def close(self):
+        """
+        Waits for every submitted clip to be processed
+        """
+        self.executor.shutdown(wait=True)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'files': self.files,
+                'failed': self.failed,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'bytes_saved': self.bytes_in - self.bytes_out,
+            }
+
+
+def create_post_processor(config, processes=1):
+    """
+    Builds the PostProcessor the addon config asks for, split across this many processes running at once
+    Returns None if post processing is turned off, or if ffmpeg can't be found
+    """
+    if not config.get('post_process'):
+        return None
+    ffmpeg = find_ffmpeg(config.get('ffmpeg_path'))
+    if not ffmpeg:
+        return None
+    workers = config.get('post_process_workers') or DEFAULT_WORKERS
+    return PostProcessor(ffmpeg, codec=config.get('post_process_codec', DEFAULT_CODEC),
+                         bitrate=config.get('post_process_bitrate', DEFAULT_BITRATE),
+                         trim_silence=config.get('post_process_trim_silence', True),
+                         normalize=config.get('post_process_normalize', True),
+                         workers=max(1, workers // max(1, processes)))
@@ -0,0 +1,124 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles throttling requests per host.
+                Every host gets its own token bucket, so a slow bot-detecting site can be kept under its limit
+                    while a local audio server is queried as fast as it can answer.
+"""
+import ipaddress
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def get_host(url):
+    """
+    Returns the lowercase host (and port) of a url, which is what requests are throttled by
+    """
+    if not url:
+        return ''
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return ''
+
+
+def is_loopback(url):
+    """
+    Whether a url points at this computer, like a local audio server
+    """
+    try:
+        hostname = urlsplit(url).hostname
+    except ValueError:
+        return False
+    if not hostname:
+        return False
+    if hostname == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(hostname).is_loopback
+    except ValueError:
+        return False
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that allows `rate` requests per second with bursts of up to `burst` requests
+    A rate of 0 (or less) means unlimited
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate or 0)
+        self.capacity = max(1.0, float(burst or 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cancel_event=None):
+        """
+        Takes a token, sleeping until one is available
+        Tokens are reserved in the order threads ask for them, so waiting threads are served fairly
+        If cancel_event is set while waiting, the reserved token is handed back and False is returned
+        """
+        if self.rate <= 0:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            if cancel_event is None:
+                time.sleep(wait)
+            elif cancel_event.wait(wait):
+                with self.lock:
+                    self.tokens = min(self.capacity, self.tokens + 1)
+                return False
+        return True
+
+
+class HostRateLimiter:
+    """
+    Keeps one TokenBucket per host
+    Hosts that were never configured get a bucket with the default rate and burst
+    """
+    def __init__(self, default_rate=0, default_burst=1):
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.limits = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def configure(self, host, rate, burst=1):
+        """
+        Sets the limit for a host
+        If several sources share a host, the most restrictive limit wins
+        """
+        host = host.lower()
+        rate = float(rate or 0)
+        burst = burst or 1
+        with self.lock:
+            if host in self.limits:
+                old_rate, old_burst = self.limits[host]
+                if old_rate > 0 and (rate <= 0 or old_rate < rate):
+                    rate = old_rate
+                burst = min(burst, old_burst)
+            self.limits[host] = (rate, burst)
+            self.buckets.pop(host, None)
+
+    def bucket_for(self, host):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                rate, burst = self.limits.get(host, (self.default_rate, self.default_burst))
+                bucket = self.buckets[host] = TokenBucket(rate, burst)
+            return bucket
+
+    def acquire(self, url, cancel_event=None):
+        """
+        Waits until a request to the url's host is allowed, returns False if cancel_event was set instead
+        """
+        return self.bucket_for(get_host(url)).acquire(cancel_event)
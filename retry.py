@@ -0,0 +1,85 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles retrying a source that failed for a moment (a 429 or 503, a dropped connection, ...),
+                    instead of falling back to a lower priority source right away.
+                The note is put back at the end of the pipeline's queue with a time it may run again, taken from the
+                    source's Retry-After header or an exponential backoff with jitter, so the workers keep going with
+                    other notes in the meantime.
+"""
+import email.utils
+import random
+import time
+
+import requests
+
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF = 1.0       # Seconds before the first retry, doubled for every retry after it
+MAX_BACKOFF = 60.0
+MAX_RETRY_AFTER = 300.0     # A source asking us to wait longer than this is given up on for the note instead
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryLater(Exception):
+    """
+    Raised by AudioDownloader.download_single when the note should be downloaded again after delay seconds
+    """
+    def __init__(self, audio_name, delay):
+        super().__init__("Retry %s in %.1f s" % (audio_name, delay))
+        self.audio_name = audio_name
+        self.delay = delay
+
+
+class RetryState:
+    """
+    What a note remembers between its tries: the retries used per source, the sources it is done with (so they
+        aren't asked again), and the log and request count of every try so far
+    """
+    __slots__ = ('retries', 'done', 'log', 'requests')
+
+    def __init__(self):
+        self.retries = {}
+        self.done = set()
+        self.log = []
+        self.requests = 0
+
+
+def is_retryable(error):
+    """
+    Whether an error from a request is likely to go away if the request is sent again a bit later
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return getattr(error, 'status_code', None) in RETRY_STATUS_CODES
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait from a Retry-After header, which is either seconds or an HTTP date, or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def retry_delay(error, retry, backoff=DEFAULT_BACKOFF):
+    """
+    Returns how many seconds to wait before the given retry (starting from 0) after error, or None to not retry
+    The source's Retry-After is honoured when it sent one, otherwise the delay is a random amount between half and
+        all of the exponential backoff, so notes that failed together don't all come back at the same moment
+    """
+    retry_after = parse_retry_after(getattr(error, 'retry_after', None))
+    if retry_after is not None:
+        return retry_after if retry_after <= MAX_RETRY_AFTER else None
+    delay = min(MAX_BACKOFF, backoff * 2 ** retry)
+    return random.uniform(delay / 2, delay)
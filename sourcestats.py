@@ -0,0 +1,142 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles keeping track of how often each source has the audio and what that costs, across runs.
+                With adaptive ordering, sources are tried in the order that costs the least per hit (the time and
+                    requests a lookup takes, divided by the chance of a hit), after any pinned sources.
+                Sources without enough lookups yet keep their place at the front, so they get measured too.
+"""
+import json
+import os
+import threading
+
+MIN_ATTEMPTS = 20           # Lookups needed before a source's place is decided by its statistics
+MAX_REMEMBERED = 1000       # Lookups remembered per source, older ones fade out as new ones are recorded
+REORDER_EVERY = 25          # The order is worked out again after this many recorded lookups
+# What every request costs on top of its latency (in seconds), so sources that answer equally fast are ordered by
+#   how many requests they need, and a busy site isn't hit when a local source does just as well
+REQUEST_COST = 0.01
+
+
+class SourceRecord:
+    __slots__ = ('attempts', 'hits', 'requests', 'latency_total')
+
+    def __init__(self, attempts=0.0, hits=0.0, requests=0.0, latency_total=0.0):
+        self.attempts = attempts
+        self.hits = hits
+        self.requests = requests
+        self.latency_total = latency_total
+
+    def hit_rate(self):
+        """
+        Chance of a hit, starting from 50% for a source that hasn't been tried
+        """
+        return (self.hits + 1.0) / (self.attempts + 2.0)
+
+    def mean_requests(self):
+        return self.requests / self.attempts if self.attempts else 1.0
+
+    def mean_latency(self):
+        return self.latency_total / self.attempts if self.attempts else None
+
+    def cost_per_hit(self):
+        """
+        The expected cost of this source for every hit it gives, its latency (which includes waiting on the rate
+            limit) plus REQUEST_COST for each request
+        Trying sources by increasing cost per hit gives the lowest expected cost until the first hit
+        """
+        return ((self.mean_latency() or 0.0) + max(self.mean_requests(), 1.0) * REQUEST_COST) / self.hit_rate()
+
+    def fade(self):
+        if self.attempts > MAX_REMEMBERED:
+            scale = MAX_REMEMBERED / self.attempts
+            self.attempts *= scale
+            self.hits *= scale
+            self.requests *= scale
+            self.latency_total *= scale
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class SourceStats:
+    def __init__(self, path=None, load=True):
+        """
+        path is the JSON file the statistics are loaded from and saved to (None to keep them for this run only)
+        load=False starts from scratch instead of using what earlier runs saved
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        self.recorded = 0
+        self.cached_order = None
+
+        if load and self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f).get('sources', {})
+                for source, values in saved.items():
+                    self.records[source] = SourceRecord(**{slot: float(values.get(slot, 0))
+                                                           for slot in SourceRecord.__slots__})
+            except (OSError, ValueError, TypeError):
+                self.records = {}
+
+    def record(self, source, hit, latency, requests=1):
+        """
+        Records the outcome of one lookup that went to the network
+        """
+        with self.lock:
+            record = self.records.get(source)
+            if record is None:
+                record = self.records[source] = SourceRecord()
+            record.attempts += 1
+            record.hits += 1 if hit else 0
+            record.requests += requests
+            record.latency_total += latency
+            record.fade()
+            self.recorded += 1
+
+    def get(self, source):
+        with self.lock:
+            return self.records.get(source)
+
+    def order(self, names, pinned=()):
+        """
+        Returns the source names in the order they should be tried
+        Pinned sources come first in their given order, then sources that still need measuring, then the rest by
+            their cost per hit
+        """
+        key = (tuple(names), frozenset(pinned))
+        with self.lock:
+            if self.cached_order and self.cached_order[0] == key and \
+                    self.recorded - self.cached_order[1] < REORDER_EVERY:
+                return self.cached_order[2]
+
+            def cost(name):
+                record = self.records.get(name)
+                if record is None or record.attempts < MIN_ATTEMPTS:
+                    return 0.0
+                return record.cost_per_hit()
+
+            ordered = [name for name in names if name in pinned]
+            ordered += sorted((name for name in names if name not in pinned), key=cost)
+            self.cached_order = (key, self.recorded, ordered)
+            return ordered
+
+    def summary(self, source):
+        """
+        Returns a short description of a source's statistics for the dialog, or '' if it hasn't been tried yet
+        """
+        record = self.get(source)
+        if record is None or not record.attempts:
+            return ''
+        return "{0:.0f}% hits, {1:.0f} ms".format(record.hits / record.attempts * 100, record.mean_latency() * 1000)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            saved = {'sources': {source: record.to_dict() for source, record in self.records.items()}}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, indent=2)
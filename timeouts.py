@@ -0,0 +1,67 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles picking the connect and read timeouts for each source's requests.
+                Every source has its own configured timeouts, which are lowered to a multiple of the rolling 99th
+                    percentile of how long the source takes to respond, once enough responses were seen. A local
+                    server that answers in milliseconds then fails fast, while a slow site keeps its longer timeouts.
+                A request that times out counts as taking the full timeout, so a source that really got slower
+                    raises its own timeout again instead of timing out over and over.
+"""
+import threading
+from collections import deque
+
+DEFAULT_CONNECT_TIMEOUT = 15.0
+DEFAULT_READ_TIMEOUT = 15.0
+DEFAULT_MULTIPLIER = 4.0
+DEFAULT_MIN_TIMEOUT = 0.5
+WINDOW = 200                # Latest responses the percentile is taken over
+MIN_SAMPLES = 50            # Responses needed before the timeouts adapt
+RECOMPUTE_EVERY = 20
+
+
+class AdaptiveTimeout:
+    def __init__(self, connect=DEFAULT_CONNECT_TIMEOUT, read=DEFAULT_READ_TIMEOUT, multiplier=DEFAULT_MULTIPLIER,
+                 minimum=DEFAULT_MIN_TIMEOUT):
+        """
+        connect and read are the configured timeouts in seconds, which are never exceeded
+        multiplier is applied to the 99th percentile response time, 0 keeps the configured timeouts
+        minimum is the lowest the timeouts are ever lowered to
+        """
+        self.connect = connect
+        self.read = read
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=WINDOW)
+        self.new_samples = 0
+        self.current = (connect, read)
+
+    def observe(self, latency):
+        """
+        Records how long a request took to respond, or its timeout if it timed out
+        """
+        if not self.multiplier:
+            return
+        with self.lock:
+            self.samples.append(latency)
+            self.new_samples += 1
+            if len(self.samples) >= MIN_SAMPLES and self.new_samples >= RECOMPUTE_EVERY:
+                self.new_samples = 0
+                ordered = sorted(self.samples)
+                p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+                adapted = max(self.minimum, p99 * self.multiplier)
+                self.current = (min(self.connect, adapted), min(self.read, adapted))
+
+    def get(self):
+        """
+        Returns the (connect, read) timeouts to use for the next request
+        """
+        return self.current
+
+    def timed_out(self):
+        """
+        Records a request that timed out
+        """
+        self.observe(max(self.current))
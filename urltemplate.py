@@ -0,0 +1,147 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles turning a source URL with {field} parameters into the URL for a note.
+                Each source URL is parsed once into a UrlTemplate, and bound once per note type into a BoundTemplate
+                    that already knows which field goes where, so rendering a note's URL is a single join.
+"""
+import re
+import threading
+from urllib.parse import quote, unquote
+
+PLACEHOLDER_RE = re.compile(r'({[^}]*})')
+
+
+class BoundTemplate:
+    """
+    A UrlTemplate bound to the field names of one note type
+    """
+    __slots__ = ('parts', 'slots', 'field_indices', 'relevant_keys')
+
+    def __init__(self, template, field_names):
+        lower_names = [name.lower() for name in field_names]
+        used = set(template.placeholders)
+
+        # Fields are resolved in the note type's field order, which is also the order the "Duplicate to empty fields"
+        #   fallback runs in: an empty field takes the value of the previous field used by the URL
+        self.field_indices = [i for i, name in enumerate(lower_names) if name in used]
+        self.relevant_keys = [field_names[i] for i in self.field_indices]
+        value_slot = {lower_names[i]: n for n, i in enumerate(self.field_indices)}
+
+        # parts holds the literal text, with None wherever a value goes and slots holding which value that is
+        self.parts = []
+        self.slots = []
+        for is_placeholder, text in template.layout:
+            if is_placeholder and text in value_slot:
+                self.slots.append((len(self.parts), value_slot[text]))
+                self.parts.append(None)
+            elif is_placeholder:
+                # Parameters that aren't a field are left in the URL as they were
+                self.parts.append('{' + text + '}')
+            else:
+                self.parts.append(text)
+
+    def resolve_values(self, field_values, duplicate_fld):
+        """
+        Returns the value used for each relevant field, applying the duplicate fallback chain
+        """
+        values = []
+        prev_val = ""
+        for i in self.field_indices:
+            value = field_values[i]
+            if value == "" and duplicate_fld:
+                value = prev_val
+            values.append(value)
+            prev_val = value
+        return values
+
+    def render(self, field_values, duplicate_fld):
+        """
+        Returns the URL for a note's field values (in the note type's field order)
+        """
+        values = [quote(value, safe='') for value in self.resolve_values(field_values, duplicate_fld)]
+        parts = self.parts[:]
+        for position, slot in self.slots:
+            parts[position] = values[slot]
+        return ''.join(parts)
+
+
+class UrlTemplate:
+    """
+    A parsed source URL, parameters are the text between {} and ignore casing
+    """
+    def __init__(self, template):
+        self.template = template
+        self.layout = []
+        self.placeholders = []
+        for sub_str in PLACEHOLDER_RE.split(template):
+            if not sub_str:
+                continue
+            if sub_str.startswith('{') and sub_str.endswith('}'):
+                name = sub_str[1:-1].lower()
+                self.layout.append((True, name))
+                if name not in self.placeholders:
+                    self.placeholders.append(name)
+            else:
+                self.layout.append((False, sub_str))
+        self.bound = {}
+        self.lock = threading.Lock()
+        self.url_re = None
+
+    def bind(self, field_names):
+        """
+        Returns the BoundTemplate for a note type's field names (a tuple), binding it on first use
+        """
+        bound = self.bound.get(field_names)
+        if bound is None:
+            with self.lock:
+                bound = self.bound.get(field_names)
+                if bound is None:
+                    bound = self.bound[field_names] = BoundTemplate(self, field_names)
+        return bound
+
+    def render(self, args_dict, duplicate_fld):
+        """
+        Returns the URL for a note's {field name: value} dict, along with the field names that were used
+        """
+        bound = self.bind(tuple(args_dict))
+        return bound.render(list(args_dict.values()), duplicate_fld), bound.relevant_keys
+
+    def values(self, args_dict, duplicate_fld):
+        """
+        Returns the {parameter: value} dict a note's {field name: value} dict fills in, without any URL quoting
+        """
+        bound = self.bind(tuple(args_dict))
+        values = bound.resolve_values(list(args_dict.values()), duplicate_fld)
+        return {name.lower(): value for name, value in zip(bound.relevant_keys, values)}
+
+    def parse(self, url):
+        """
+        Returns the {parameter: value} dict a URL rendered from this template was filled in with, or None if the URL
+            doesn't come from it
+        Parameters that weren't a field of the note are left out
+        """
+        if self.url_re is None:
+            pattern = []
+            seen = set()
+            for is_placeholder, text in self.layout:
+                if not is_placeholder:
+                    pattern.append(re.escape(text))
+                elif text in seen:
+                    pattern.append('(?P=p%d)' % self.placeholders.index(text))
+                else:
+                    # Rendered values are quoted, so they never hold any of the characters that split up a URL
+                    pattern.append('(?P<p%d>[^/?#&=]*)' % self.placeholders.index(text))
+                    seen.add(text)
+            self.url_re = re.compile(''.join(pattern))
+
+        match = self.url_re.fullmatch(url)
+        if match is None:
+            return None
+        values = {}
+        for i, name in enumerate(self.placeholders):
+            value = match.group('p%d' % i)
+            if value != '{' + name + '}':
+                values[name] = unquote(value)
+        return values
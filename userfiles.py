@@ -0,0 +1,20 @@
+"""
+This addon and all code included is open-source under the Apache-2.0 License
+
+Author:         Dillon Wall
+Description:    This file handles locating the addon's user_files folder.
+                Anki keeps this folder when the addon is updated, so anything that should survive between runs
+                    (caches, journals, reports, ...) is stored there.
+"""
+import os
+
+USER_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_files')
+
+
+def user_files_path(*parts):
+    """
+    Returns a path inside user_files, creating any folders leading up to it
+    """
+    path = os.path.join(USER_FILES_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path